@@ -1,13 +1,14 @@
 from __future__ import print_function
 import os
-import cPickle
-import re
+import time
+import collections
 import argparse
 
-import scipy.io as sio
-import numpy as np
-from scipy.constants import e as const_e
-from scipy.io.matlab.miobase import MatReadError
+import ingestion
+import derived_quantities
+import segment_store
+import instrumentation
+import sidecar_cache
 
 
 # Argparse
@@ -30,6 +31,24 @@ parser.add_argument('--energy', action='store_true')
 parser.add_argument('--quad', action='store_true')
 parser.add_argument('--multip', action='store_true')
 parser.add_argument('--mono', action='store_true')
+parser.add_argument('--jobs', '-j', help='Number of worker processes that load the mat files. Default: 1.', type=int, default=1, metavar='N')
+parser.add_argument('--prefetch', help='Load up to K mat files ahead in threads while reducing the current one. Default: 0.', type=int, default=0, metavar='K')
+parser.add_argument('--sidecar-cache', help='Cache the mat file variables in .npy sidecar files. Default: Off.', action='store_true')
+parser.add_argument('--cache-dir', help='Directory for the sidecar files. Default: next to each mat file.')
+parser.add_argument('--cache-max-mb', help='Size limit of the sidecar cache in MB.', type=float)
+parser.add_argument('--derived', help='Comma separated derived quantities to compute and store, or all. Choices: %s.' % ', '.join(derived_quantities.registry), default='')
+parser.add_argument('--append', help='Write only the new results, as segments next to the pickles, during the run. The results store gets a segment with the same rows. Default: Off.', action='store_true')
+parser.add_argument('--flush-every', help='With --append, write a segment after this many simulations. Default: 100.', type=int, default=100, metavar='N')
+parser.add_argument('--flush-seconds', help='With --append, write a segment at least this often. Default: 300.', type=float, default=300., metavar='T')
+parser.add_argument('--compact', help='Merge the segments into the pickles and rebuild the results store, without scanning DIR.', action='store_true')
+parser.add_argument('--shard', help='Only process the folders of shard I of N (0 <= I < N) and write them to a partial result file. Merge the partials with 003_merge_pyecloud_partials.py.', metavar='I/N')
+parser.add_argument('--timing', help='Print the time spent in each stage at the end. Default: Off.', action='store_true')
+parser.add_argument('--profile', help='Run cProfile inside this stage, e.g. load or dump, and print the statistics.', metavar='STAGE')
+parser.add_argument('--chunk-size', help='Read the histograms in chunks of this many elements to bound the memory use. The results are identical to the default reading.', type=int, metavar='N')
+parser.add_argument('--no-header-check', help='Do not check the variable directory of the mat files before loading them.', dest='header_check', action='store_false')
+parser.add_argument('--retry-quarantined', help='Also retry the mat files that failed before and did not change since. Default: Off.', action='store_true')
+parser.add_argument('--compact-hist', help='Store the nel_hist rows with smaller dtypes or sparse where this is lossless, see compact_hist.py. Default: Off.', action='store_true')
+parser.add_argument('--multi-study', help='Ingest all selected studies (default: all) in one scan of DIR. The results of each study are written to DIR/pyecloud3_<study>/.', action='store_true')
 
 parser.add_argument('dir', help='Directory with the simulations.', metavar='DIR')
 
@@ -44,119 +63,84 @@ def my_print(*args, **kwargs):
 if not os.path.isdir(root_dir):
     raise ValueError('DIR is not a directory')
 
+if args.timing or args.profile:
+    instrumentation.enable(args.profile)
+
 # Config
-hl_pkl_name = root_dir + '/heatload_pyecloud3.pkl'
-nel_hist_pkl_name = root_dir + '/nel_hist_pyecloud3.pkl'
-path_pkl_name = root_dir + '/paths_matfiles_pyecloud.pkl'
 fail_name = './fail_list.txt'
+quarantine_name = root_dir + '/quarantine_pyecloud3.pkl'
 
-path_dict = {}
-
-if args.d:
-    hl_dict = {}
-    nel_hist_dict = {}
+if args.derived == 'all':
+    derived_names = list(derived_quantities.registry)
 else:
-    if os.path.isfile(hl_pkl_name):
-        with open(hl_pkl_name,'r') as f:
-            hl_dict = cPickle.load(f)
-    else:
-        hl_dict = {}
-    if os.path.isfile(nel_hist_pkl_name):
-        with open(nel_hist_pkl_name,'r') as f:
-            nel_hist_dict = cPickle.load(f)
-    else:
-        nel_hist_dict = {}
+    derived_names = [name for name in args.derived.split(',') if name]
+for name in derived_names:
+    if name not in derived_quantities.registry:
+        raise ValueError('Unknown derived quantity %s' % name)
+
+if args.sidecar_cache or args.cache_dir:
+    max_bytes = None if args.cache_max_mb is None else args.cache_max_mb*1e6
+    mat_cache = sidecar_cache.sidecar_cache(args.cache_dir, max_bytes)
+else:
+    mat_cache = None
+
+if args.d and args.compact:
+    raise ValueError('-d and --compact cannot be combined')
+if args.shard and (args.append or args.compact):
+    raise ValueError('--shard cannot be combined with --append or --compact')
+shard = ingestion.parse_shard(args.shard) if args.shard else None
+
+append = args.append and not args.d
+# Only the new results are written, as segments or as a partial result file
+write_new_only = append or shard is not None
 
-all_files = os.listdir(root_dir)
 # Regular Expression for the folder names
-if args.f:
-    folder_re = re.compile('^Fill(\d+)_cut(\d+\.\d[1-9]*)0*h_\d+GeV_for_triplets_(B[1,2])_LHC_([A-Za-z]+)_\d+GeV_sey([\d\.]+)_coast([\d\.]+)$')
-    identifiers = ['filln', 'time_of_interest', 'beam', 'device', 'sey', 'coast']
-elif args.emax:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_Emax_(\d+)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'emax']
-elif args.s:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_s_param(\d+\.\d+)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 's']
-elif args.musig:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_ctr_(\d+)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'ctr']
-elif args.mu:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_ctr_(\d\.\d)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'fact_mu']
-elif args.theta:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_theta_(\d\.\d)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'theta']
-elif args.r0:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_R0_(\d\.\d)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'r0']
-elif args.ctr:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_ctr_(\d)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'ctr']
-elif args.sext:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_([df])')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'df']
-elif args.dipquad:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb')
-    identifiers = ['device', 'energy', 'sey', 'intensity']
-elif args.substeps:
-    folder_re = re.compile('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_f_substeps_(\d+)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'substeps']
-elif args.cell:
-    folder_re = re.compile('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\d)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'photoemission']
-elif args.energy:
-    folder_re = re.compile('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\w+)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'distribution']
-elif args.quad:
-    folder_re = re.compile('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\d+\.\d)Tpm')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'b_field']
-elif args.multip:
-    folder_re = re.compile('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\d+)')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'b_field_id']
-elif args.mono:
-    folder_re = re.compile('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_mono_(\d+\.\d+)eV')
-    identifiers = ['device', 'energy', 'sey', 'intensity', 'photoelectron_energy']
+selected = [study for study in ingestion.studies if getattr(args, study)]
+if args.multi_study:
+    outputs = [ingestion.study_results(study, os.path.join(root_dir, 'pyecloud3_' + study), args.compact_hist) for study in selected or ingestion.studies]
+elif selected:
+    # The first study in the order of ingestion.studies
+    outputs = [ingestion.study_results(selected[0], root_dir, args.compact_hist)]
 else:
     raise ValueError('Regex not specified!')
 
+with instrumentation.stage('load pickles'):
+    # With --append or --shard, the new results are also collected
+    for output in outputs:
+        output.load(fresh=args.d, collect_new=write_new_only)
+    # Also kept with -d, so that failed and unfinished simulations are not read again
+    quarantine_segments = segment_store.segment_files(quarantine_name)
+    quarantine = ingestion.load_quarantine(quarantine_name, quarantine_segments)
+
+if args.compact:
+    with instrumentation.stage('dump'):
+        for output in outputs:
+            output.write()
+    with instrumentation.stage('save store'):
+        for output in outputs:
+            output.save_store()
+    print('Merged %i segments.' % sum(len(files) for output in outputs for files in output.segments.values()))
+    if instrumentation.enabled:
+        print(instrumentation.report())
+    raise SystemExit
+
+with instrumentation.stage('list directory'):
+    all_files = ingestion.list_folders(root_dir)
+
 fail_ctr = 0
 success_ctr = 0
+quarantine_ctr = 0
+# Newly failed folders and quarantined folders that were reduced successfully
+new_quarantine = {}
+recovered = []
 
 fail_lines = ''
 fail_lines_IO = ''
-const_LHC_frev = 11.2455e3
 
 # Functions
-def insert_to_nested_dict(dictionary, value, keys, must_enter=False, add_up=False):
-    """
-    Inserts value to nested dictionary. The location is specified by keys.
-    If must_enter is set to True, an error is raised if the entry is already present.
-    """
-    for key in keys[:-1]:
-        if key not in dictionary:
-            dictionary[key] = {}
-        dictionary = dictionary[key]
-
-    last_key = keys[-1]
-    if last_key not in dictionary:
-        dictionary[last_key] = value
-    elif add_up:
-        dictionary[last_key] += value
-    elif must_enter:
-        raise ValueError('Key %s already exists!' % last_key)
-
-def check_if_already_exist(dictionary, keys):
-    """
-    Returns True if a nested dict with the keys in the correct order does exist.
-    """
-    try:
-        for key in keys:
-            dictionary = dictionary[key]
-    except KeyError:
-        return False
-    else:
-        return True
+# Shared with 003_merge_pyecloud_partials.py
+insert_to_nested_dict = ingestion.insert_to_nested_dict
+check_if_already_exist = ingestion.check_if_already_exist
 
 #def sort_new_dict_recursively(dictionary):
 #    for key in dictionary:
@@ -177,68 +161,149 @@ def check_if_already_exist(dictionary, keys):
 #        else:
 #            raise ValueError('Unknown type!')
 
-# Main loop
-for folder in all_files:
-    file_info = re.search(folder_re,folder)
-    if file_info is None:
-        my_print('Folder %s did not match the regex!' % folder)
-        continue
-    keys = list(file_info.groups())
-
-    id_dict = {}
-    for identifier, info in zip(identifiers, keys):
-        id_dict[identifier] = info
-    my_print(keys)
-
-
-    if not args.d and check_if_already_exist(hl_dict, keys):
-        my_print('Continuing for', keys)
-        continue
-
-    mat_str = os.path.abspath(root_dir) + '/' + folder + '/Pyecltest.mat'
-    if not os.path.isfile(mat_str):
-        print('Warning: file %s does not exist' % mat_str)
-        fail_ctr += 1
-        fail_lines += folder + '\n'
-        continue
+def flush_segments():
+    """
+    With --append, writes the results collected so far as segments, so that a crash loses
+    at most the simulations since the last call.
+    """
+    with instrumentation.stage('dump'):
+        for output in outputs:
+            output.append()
+        # Removes the recovered folders from the quarantine, see ingestion.load_quarantine
+        new_quarantine.update((folder, None) for folder in recovered)
+        segment_store.append(quarantine_name, new_quarantine)
+        new_quarantine.clear()
+        del recovered[:]
 
-    my_print('Trying to read %s.' % mat_str)
-    try:
-        matfile = sio.loadmat(mat_str)
-    except (IOError, MatReadError):
+# Main loop
+# First collect the folders to be loaded, then load and reduce them (possibly in parallel).
+# With --multi-study, every folder goes to the first study whose regex matches its full name.
+router = ingestion.study_router(outputs, full_match=args.multi_study)
+# Studies with folders in DIR, in any shard
+matched_studies = set()
+# (study, studies that also match) -> number of folders
+ambiguous = collections.Counter()
+tasks = []
+with instrumentation.stage('match folders'):
+    for folder in all_files:
+        route = router.route(folder)
+        if route is None:
+            my_print('Folder %s did not match the regex!' % folder)
+            continue
+        output, keys = route
+        matched_studies.add(output.study)
+        if args.multi_study:
+            others = router.other_matches(folder, output)
+            if others:
+                my_print('Folder %s also matches %s, using %s' % (folder, ', '.join(others), output.study))
+                ambiguous[output.study, ', '.join(others)] += 1
+        if shard is not None and not ingestion.in_shard(folder, shard):
+            continue
+        my_print(keys)
+
+        mat_str = os.path.abspath(root_dir) + '/' + folder + '/Pyecltest.mat'
+        state = ingestion.mat_file_state(mat_str)
+
+        # Unchanged since the last reduction, or removed after it: keep the old entries
+        if output.is_current(folder, keys, state, derived_names):
+            my_print('Continuing for', keys)
+            continue
+
+        if state is None:
+            print('Warning: file %s does not exist' % mat_str)
+            fail_ctr += 1
+            fail_lines += folder + '\n'
+            continue
+
+        if not args.retry_quarantined and ingestion.is_quarantined(quarantine, folder, state):
+            my_print('Skipping quarantined %s: %s' % (folder, quarantine[folder][1]))
+            quarantine_ctr += 1
+            continue
+
+        if args.header_check:
+            with instrumentation.stage('check headers'):
+                reason = ingestion.check_matfile(mat_str)
+            if reason is not None:
+                print('Warning: %s: %s' % (mat_str, reason))
+                fail_ctr += 1
+                fail_lines_IO += folder + '\n'
+                new_quarantine[folder] = (state, reason)
+                continue
+
+        tasks.append((folder, output, keys, mat_str, state))
+
+for (study, others), n_folders in sorted(ambiguous.items()):
+    print('Warning: %i folders of %s also match %s' % (n_folders, study, others))
+
+results = ingestion.reduce_matfiles([task[3] for task in tasks], jobs=args.jobs, cache=mat_cache, chunk_size=args.chunk_size,
+        prefetch_depth=args.prefetch, derived=derived_names)
+n_unflushed = 0
+last_flush = time.time()
+for folder, output, keys, mat_str, state in tasks:
+    result = next(results)
+    my_print('Reading %s.' % mat_str)
+    if result is None:
         print('IOError')
         fail_ctr += 1
         fail_lines_IO += folder + '\n'
+        new_quarantine[folder] = (state, 'Read error')
         continue
     else:
         success_ctr += 1
+        if folder in quarantine:
+            recovered.append(folder)
 
-    heatload = np.sum(matfile['energ_eV_impact_hist'])*const_LHC_frev*const_e
-    e_transverse_hist = np.sum(matfile['nel_hist'],axis=0)
-
+    with instrumentation.stage('insert'):
+        output.insert(folder, keys, mat_str, state, result)
 
-    insert_to_nested_dict(hl_dict, heatload, keys)
-    insert_to_nested_dict(nel_hist_dict, e_transverse_hist, keys, must_enter=True)
-    insert_to_nested_dict(path_dict, mat_str, keys, must_enter=True)
+    if append:
+        n_unflushed += 1
+        if n_unflushed >= args.flush_every or time.time() - last_flush >= args.flush_seconds:
+            flush_segments()
+            n_unflushed = 0
+            last_flush = time.time()
 
-# add xg_hist variable only once
-    if 'xg_hist' not in nel_hist_dict:
-        insert_to_nested_dict(nel_hist_dict, matfile['xg_hist'][0], ['xg_hist'], must_enter=True)
+if args.multi_study:
+    # No output directories for the studies that are not in DIR
+    outputs = [output for output in outputs if output.study in matched_studies or os.path.isdir(output.output_dir)]
 
-with open(hl_pkl_name, 'w') as pkl_file:
-    cPickle.dump(hl_dict, pkl_file, -1)
-
-with open(nel_hist_pkl_name, 'w') as pkl_file:
-    cPickle.dump(nel_hist_dict, pkl_file, -1)
-
-with open(path_pkl_name, 'w') as pkl_file:
-    cPickle.dump(path_dict, pkl_file, -1)
+if append:
+    flush_segments()
+else:
+    with instrumentation.stage('dump'):
+        for output in outputs:
+            if shard is not None:
+                output.write_partial(shard, fail_lines, fail_lines_IO)
+            else:
+                output.write()
+        if shard is not None:
+            new_quarantine.update((folder, None) for folder in recovered)
+            segment_store.append(quarantine_name, new_quarantine)
+        elif new_quarantine or recovered or quarantine_segments:
+            quarantine.update(new_quarantine)
+            for folder in recovered:
+                del quarantine[folder]
+            segment_store.write(quarantine_name, quarantine, quarantine_segments)
+
+if not write_new_only:
+    with instrumentation.stage('save store'):
+        for output in outputs:
+            output.save_store()
 
 print('%i simulations were successful and %i failed.' % (success_ctr,fail_ctr))
 print('Fails:')
 print(fail_lines)
 print('IO fails:')
 print(fail_lines_IO)
+if quarantine_ctr:
+    print('%i quarantined simulations were skipped, use --retry-quarantined to read them again.' % quarantine_ctr)
+
+if instrumentation.enabled:
+    instrumentation.count('folders', len(all_files))
+    instrumentation.count('folders reduced', len(tasks))
+    print(instrumentation.report())
+    if args.profile:
+        print(instrumentation.profile_report())
 
 #with open(fail_name,'w') as fail_file:
 #    fail_file.write(fail_lines)
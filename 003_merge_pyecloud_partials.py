@@ -0,0 +1,88 @@
+from __future__ import print_function
+import os
+import glob
+import argparse
+
+import ingestion
+import segment_store
+import results_store
+import utils
+
+parser = argparse.ArgumentParser(description='Merges the partial results of 001_create_pickle_pyecloud_results.py --shard into the result pickles.')
+parser.add_argument('-d', help='Ignore the existing pickles and build them from the partials only. Default: Off.', action='store_true')
+parser.add_argument('--keep', help='Keep the partial files after merging. Default: Off.', action='store_true')
+parser.add_argument('dir', help='Directory with the simulations.', metavar='DIR')
+args = parser.parse_args()
+root_dir = args.dir
+
+# Same names as in 001_create_pickle_pyecloud_results.py
+hl_pkl_name = root_dir + '/heatload_pyecloud3.pkl'
+nel_hist_pkl_name = root_dir + '/nel_hist_pyecloud3.pkl'
+path_pkl_name = root_dir + '/paths_matfiles_pyecloud.pkl'
+store_name = root_dir + '/results_pyecloud3'
+manifest_name = root_dir + '/manifest_pyecloud3.pkl'
+derived_pkl_name = root_dir + '/derived_pyecloud3.pkl'
+partials_dir = root_dir + '/partials_pyecloud3'
+
+partial_files = sorted(glob.glob(os.path.join(partials_dir, 'shard_*_of_*.pkl')))
+if not partial_files:
+    raise ValueError('No partial results in %s' % partials_dir)
+
+partials = [(partial_file, utils.load_pkl(partial_file)) for partial_file in partial_files]
+identifiers = partials[0][1]['identifiers']
+n_shards = partials[0][1]['shard'][1]
+for partial_file, partial in partials:
+    if partial['identifiers'] != identifiers:
+        raise ValueError('%s has other identifiers: %s' % (partial_file, partial['identifiers']))
+    if partial['shard'][1] != n_shards:
+        raise ValueError('%s is a shard of %i, others of %i' % (partial_file, partial['shard'][1], n_shards))
+missing = sorted(set(xrange(n_shards)) - set(partial['shard'][0] for _, partial in partials))
+if missing:
+    print('Warning: no partial results for shards %s' % ', '.join(map(str, missing)))
+
+# Depth of the entries of each result dict
+depth = {
+        hl_pkl_name: len(identifiers),
+        nel_hist_pkl_name: len(identifiers),
+        path_pkl_name: len(identifiers),
+        derived_pkl_name: len(identifiers) + 1,
+        manifest_name: 1,
+        }
+
+# The shards are disjoint, so every entry must come from one partial only
+new_dicts = {pkl_name: {} for pkl_name in depth}
+for partial_file, partial in partials:
+    for pkl_name, dict_ in partial['results'].iteritems():
+        for keys, value in utils.flatten_nested_dict(dict_, depth[pkl_name]):
+            try:
+                ingestion.insert_to_nested_dict(new_dicts[pkl_name], value, keys, must_enter=True)
+            except ValueError:
+                raise ValueError('Conflict for %s in %s: %s is in several partials' % (os.path.basename(pkl_name), partial_file, '/'.join(keys)))
+    if 'xg_hist' in partial['results'][nel_hist_pkl_name]:
+        new_dicts[nel_hist_pkl_name]['xg_hist'] = partial['results'][nel_hist_pkl_name]['xg_hist']
+
+# The partials replace the entries of folders that changed since the last merge
+segments = {pkl_name: segment_store.segment_files(pkl_name) for pkl_name in depth}
+merged = {}
+for pkl_name, new_dict in new_dicts.iteritems():
+    if args.d:
+        merged[pkl_name] = new_dict
+    else:
+        merged[pkl_name] = segment_store.merge(segment_store.load(pkl_name, segments[pkl_name]), new_dict)
+
+for pkl_name, dict_ in merged.iteritems():
+    if dict_ or pkl_name != derived_pkl_name:
+        segment_store.write(pkl_name, dict_, segments[pkl_name])
+
+store = results_store.results_store.from_dicts(identifiers, merged[hl_pkl_name], merged[nel_hist_pkl_name], merged[path_pkl_name])
+store.save(store_name, results_store.segment_dirs(store_name))
+
+if not args.keep:
+    for partial_file, _ in partials:
+        os.remove(partial_file)
+
+print('Merged %i new results from %i partials.' % (len(utils.flatten_nested_dict(new_dicts[hl_pkl_name], len(identifiers))), len(partials)))
+for label in 'fail_lines', 'fail_lines_IO':
+    fails = ''.join(partial[label] for _, partial in partials)
+    print('%s:' % ('Fails' if label == 'fail_lines' else 'IO fails'))
+    print(fails)
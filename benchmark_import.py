@@ -0,0 +1,54 @@
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+parser = argparse.ArgumentParser(description='Measures the import time of a module of this repository in fresh interpreters.')
+parser.add_argument('--module', help='Module to import. Default: simulation_study.', default='simulation_study')
+parser.add_argument('-n', help='Number of imports. Default: 20.', type=int, default=20)
+parser.add_argument('--baseline', help='Also measure the tree of this git revision, e.g. HEAD~1.', metavar='REV')
+args = parser.parse_args()
+
+this_dir = os.path.abspath(os.path.dirname(__file__))
+heavy_modules = ['scipy', 'scipy.io', 'scipy.constants', 'HeatLoadCalculators']
+
+check_code = """
+import sys, time
+t0 = time.time()
+import %s
+dt = time.time() - t0
+print(repr((dt, [name for name in %r if name in sys.modules])))
+"""
+
+def measure(directory):
+    """
+    Returns the median import time in s and the heavy modules loaded by the import.
+    """
+    code = check_code % (args.module, heavy_modules)
+    times = []
+    for _ in xrange(args.n):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=directory)
+        dt, loaded = eval(output.strip().splitlines()[-1])
+        times.append(dt)
+    return sorted(times)[len(times)//2], loaded
+
+def report(label, directory):
+    dt, loaded = measure(directory)
+    print('%-12s %8.1f ms   loaded: %s' % (label, dt*1e3, ', '.join(loaded) or '-'))
+    return dt
+
+dt_current = report('current', this_dir)
+
+if args.baseline:
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        archive = subprocess.Popen(['git', 'archive', args.baseline], cwd=this_dir, stdout=subprocess.PIPE)
+        subprocess.check_call(['tar', '-x', '-C', tmp_dir], stdin=archive.stdout)
+        archive.wait()
+        dt_baseline = report(args.baseline, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('Speedup: %.1f' % (dt_baseline/dt_current))
@@ -0,0 +1,131 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+import synthetic_dataset
+import ingestion
+import utils
+import simulation_study
+
+parser = argparse.ArgumentParser(description='Times ingestion and analysis on synthetic sweeps of several sizes.')
+parser.add_argument('--sizes', help='Numbers of simulations per sweep. Default: 10,100.', default='10,100')
+parser.add_argument('--study', help='Study type of the sweeps. Default: f.', default='f', choices=sorted(ingestion.studies))
+parser.add_argument('--passages', help='Bunch passages per simulation. Default: 100.', type=int, default=100)
+parser.add_argument('--steps-per-passage', help='Time steps per bunch passage. Default: 10.', type=int, default=10)
+parser.add_argument('--bins', help='Number of histogram bins. Default: 100.', type=int, default=100)
+parser.add_argument('-n', help='Repetitions of each measurement, the median is reported. Default: 3.', type=int, default=3)
+parser.add_argument('--dir', help='Directory for the sweeps. Default: temporary directory, deleted afterwards.')
+parser.add_argument('--output', '-o', help='Write the results as JSON to this file.')
+args = parser.parse_args()
+
+this_dir = os.path.abspath(os.path.dirname(__file__))
+ingestion_script = os.path.join(this_dir, '001_create_pickle_pyecloud_results.py')
+
+def median_time(func, n=args.n, setup=None):
+    """
+    setup: if given, called before each repetition without timing, func gets its result
+    """
+    times = []
+    for _ in xrange(n):
+        func_args = () if setup is None else (setup(),)
+        t0 = time.time()
+        func(*func_args)
+        times.append(time.time() - t0)
+    return sorted(times)[len(times)//2]
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=this_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def has_run(names, var_arr):
+    """
+    True if one of the runs of synthetic_dataset.write_sweep matches var_arr, where VAR matches any value.
+    """
+    return any(all(var in ('VAR', key) for var, key in zip(var_arr, keys)) for _, keys in names)
+
+def benchmark_sweep(root_dir, n_runs):
+    """
+    Returns a dict of benchmark name -> median time in s for a sweep of n_runs simulations.
+    """
+    names = synthetic_dataset.write_sweep(root_dir, args.study, n_runs, args.passages, args.steps_per_passage, args.bins)
+    identifiers = ingestion.studies[args.study][1]
+    output = {}
+
+    output['ingestion'] = median_time(lambda: subprocess.check_call(
+        [sys.executable, ingestion_script, '--'+args.study if len(args.study) > 1 else '-'+args.study, '-d', root_dir],
+        cwd=root_dir, stdout=open(os.devnull, 'w')))
+
+    hl_dict = utils.load_pkl(os.path.join(root_dir, 'heatload_pyecloud3.pkl'))
+    keys = names[0][1]
+    var_arr = list(keys)
+    var_arr[identifiers.index('sey')] = 'VAR'
+    output['create_lists'] = median_time(lambda: utils.create_lists(hl_dict, var_arr))
+    if 'beam' in identifiers:
+        var_arr[identifiers.index('beam')] = 'B2'
+    # Sweeps of a single run have no B2
+    if 'beam' in identifiers and has_run(names, var_arr):
+        var_arr[identifiers.index('beam')] = 'BEAMS'
+        output['create_lists_beams'] = median_time(lambda: utils.create_lists_beams(hl_dict, var_arr))
+
+    paths = [os.path.join(root_dir, name, 'Pyecltest.mat') for name, _ in names]
+    def construct():
+        utils.input_file_cache.clear()
+        return [simulation_study.simulation_from_path(path) for path in paths]
+    output['simulation_from_path'] = median_time(construct)
+
+    # Cold: new simulations in every repetition, which read the mat files and build the
+    # bunch index. Warm: the same simulations again, with their cached arrays.
+    heatload_passage = lambda sims: [sim.heatload_passage() for sim in sims]
+    heatload_rescaled = lambda sims: [sim.heatload_rescaled(40, 2748) for sim in sims]
+    output['heatload_passage cold'] = median_time(heatload_passage, setup=construct)
+    output['heatload_rescaled cold'] = median_time(heatload_rescaled, setup=construct)
+    sims = construct()
+    heatload_passage(sims)
+    heatload_rescaled(sims)
+    output['heatload_passage warm'] = median_time(lambda: heatload_passage(sims))
+    output['heatload_rescaled warm'] = median_time(lambda: heatload_rescaled(sims))
+    return output
+
+sizes = map(int, args.sizes.split(','))
+if min(sizes) < 1:
+    parser.error('The sizes must be at least 1')
+base_dir = args.dir or tempfile.mkdtemp()
+results = []
+try:
+    for n_runs in sizes:
+        root_dir = os.path.join(base_dir, '%s_%i' % (args.study, n_runs))
+        timings = benchmark_sweep(root_dir, n_runs)
+        for name, dt in sorted(timings.items()):
+            print('%6i runs  %-22s %10.2f ms' % (n_runs, name, dt*1e3))
+            results.append({'n_runs': n_runs, 'benchmark': name, 'time': dt})
+finally:
+    if args.dir is None:
+        shutil.rmtree(base_dir)
+
+if args.output:
+    report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'parameters': {
+                'study': args.study,
+                'passages': args.passages,
+                'steps_per_passage': args.steps_per_passage,
+                'bins': args.bins,
+                'repetitions': args.n,
+                },
+            'results': results,
+            }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
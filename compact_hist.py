@@ -0,0 +1,103 @@
+"""
+Opt-in compact storage of histograms, which are mostly counts or mostly zero.
+
+compact stores an array with the smallest dtype that reproduces it within rtol
+(integers for counts, float32 otherwise), and as its nonzero elements only if that
+is smaller. dense returns the original array again, plain arrays pass through.
+shared returns one array object for equal axes, such as the xg_hist of many runs.
+
+Usage in a notebook:
+    import utils, compact_hist
+    utils.compact_variables = compact_hist.hist_variables
+The ingestion script stores the nel_hist rows compact with --compact-hist.
+"""
+from __future__ import division
+import hashlib
+
+import numpy as np
+
+# Histograms of Pyecltest.mat and their axes
+hist_variables = ('nel_hist', 'En_hist', 'cos_angle_hist', 'energ_eV_impact_hist', 'xg_hist', 'En_g_hist')
+axis_variables = ('xg_hist', 'En_g_hist')
+
+_int_dtypes = [np.dtype(dtype) for dtype in ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32')]
+
+class compact_array(object):
+    """
+    values: the elements in a smaller dtype, all of them or only the nonzero ones at indices
+    indices: flat indices of values, or None
+    """
+    def __init__(self, shape, dtype, values, indices=None):
+        self.shape = shape
+        self.dtype = dtype
+        self.values = values
+        self.indices = indices
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.indices is None else self.indices.nbytes)
+
+    def dense(self):
+        if self.indices is None:
+            return self.values.astype(self.dtype).reshape(self.shape)
+        output = np.zeros(int(np.prod(self.shape)), dtype=self.dtype)
+        output[self.indices] = self.values
+        return output.reshape(self.shape)
+
+def narrow(values, rtol=1e-6):
+    """
+    Returns values in the smallest dtype that reproduces them within rtol.
+    """
+    if values.dtype.kind not in 'fiu' or values.size == 0:
+        return values
+    if np.all(np.isfinite(values)) and np.all(values == np.round(values)):
+        for dtype in _int_dtypes:
+            if dtype.itemsize >= values.dtype.itemsize:
+                break
+            info = np.iinfo(dtype)
+            if values.min() >= info.min and values.max() <= info.max:
+                return values.astype(dtype)
+    if values.dtype.kind == 'f' and values.dtype.itemsize > 4:
+        narrowed = values.astype(np.float32)
+        if np.allclose(narrowed, values, rtol=rtol, atol=0, equal_nan=True):
+            return narrowed
+    return values
+
+def compact(array, rtol=1e-6):
+    """
+    Returns a compact_array of array, or array itself if that is not smaller.
+    """
+    array = np.asarray(array)
+    if array.dtype.kind not in 'fiu' or array.size == 0:
+        return array
+    flat = array.ravel()
+    values = narrow(flat, rtol)
+    output = compact_array(array.shape, array.dtype, values)
+    nonzero = np.flatnonzero(flat)
+    index_dtype = np.uint16 if flat.size <= 2**16 else np.uint32
+    if len(nonzero)*(np.dtype(index_dtype).itemsize + values.itemsize) < values.nbytes:
+        output = compact_array(array.shape, array.dtype, narrow(flat[nonzero], rtol), nonzero.astype(index_dtype))
+    if output.nbytes >= array.nbytes:
+        return array
+    return output
+
+def dense(value):
+    """
+    Returns the dense array of a compact_array, other values unchanged.
+    """
+    if isinstance(value, compact_array):
+        return value.dense()
+    return value
+
+_shared = {}
+
+def shared(array):
+    """
+    Returns an array equal to array, the same object for all equal arrays passed here.
+    """
+    array = np.asarray(array)
+    key = array.dtype.str, array.shape, hashlib.sha1(np.ascontiguousarray(array).view(np.uint8)).hexdigest()
+    return _shared.setdefault(key, array)
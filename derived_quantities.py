@@ -0,0 +1,88 @@
+"""
+Registry of quantities derived from one simulation, such as the heat load per bunch passage.
+
+The ingestion script computes the selected quantities in the same pass over each
+Pyecltest.mat as the heat load, and stores them in derived_pyecloud3.pkl as
+name -> nested dict with the same keys as heatload_pyecloud3.pkl.
+heatload_study then serves them without opening the mat files again.
+
+To add a quantity, register a function of a simulation_from_path object
+together with the mat variables that it reads:
+
+    register('max_electrons', ['Nel_timep'], lambda sim: np.max(sim.mat['Nel_timep']))
+"""
+import collections
+
+import simulation_study
+
+# name -> (mat variables, function of a simulation or None for the method of the same name)
+registry = collections.OrderedDict()
+
+def register(name, variables, func=None):
+    """
+    func: function of a simulation_from_path object. Default: the method name.
+    """
+    registry[name] = (list(variables), func)
+
+def variables(names):
+    """
+    Mat variables needed to compute all of names.
+    """
+    output = []
+    for name in names:
+        for variable in registry[name][0]:
+            if variable not in output:
+                output.append(variable)
+    return output
+
+def compute(sim, names):
+    """
+    Returns a dict of name -> value for names evaluated on sim.
+    The variables of all names are loaded in one pass over the mat file,
+    unless sim reads its time series in streaming mode.
+    Quantities that fail, e.g. because a variable is missing, are left out with a warning.
+    """
+    if not sim.streaming:
+        sim.mat.load(*[variable for variable in variables(names) if variable in sim.mat])
+    output = {}
+    for name in names:
+        _, func = registry[name]
+        try:
+            if func is None:
+                output[name] = getattr(sim, name)()
+            else:
+                output[name] = func(sim)
+        except Exception as e:
+            print('Warning: derived quantity %s failed for %s: %r' % (name, sim.mat.filename, e))
+    return output
+
+def compute_from_matfile(mat_str, names, loaded=None, cache=None, streaming=False, chunk_size=None):
+    """
+    Evaluates names on the simulation of mat_str.
+    loaded: dict of variables that were already read from mat_str
+    """
+    try:
+        sim = simulation_study.simulation_from_path(mat_str, cache, streaming, chunk_size)
+    except IOError:
+        # Without input files, only the quantities that depend on the mat file work
+        sim = simulation_study.simulation(mat_str, cache)
+    if loaded is not None:
+        for key, value in loaded.iteritems():
+            if not key.startswith('__'):
+                dict.__setitem__(sim.mat, key, value)
+    return compute(sim, names)
+
+register('heatload_total', ['En_imp_eV_time'])
+register('heatload_passage', ['t', 'En_imp_eV_time'])
+register('electrons_in_chamber', ['t', 'Nel_timep'])
+register('electrons_total_from_hist', ['nel_hist'])
+register('angle_hist_total', ['cos_angle_hist'])
+register('kinetic_energy', ['t', 'En_kin_eV_time'])
+register('central_density', ['t', 'cen_density'])
+register('energy_impact_hist', ['xg_hist', 'energ_eV_impact_hist'])
+register('en_hist', ['En_g_hist', 'En_hist'])
+
+# Served by heatload_study.create_lists_path for calls with n_points
+register('electrons_in_chamber_envelope', ['t', 'Nel_timep'], lambda sim: sim.get_envelope('Nel_timep'))
+register('kinetic_energy_envelope', ['t', 'En_kin_eV_time'], lambda sim: sim.get_envelope('En_kin_eV_time'))
+register('central_density_envelope', ['t', 'cen_density'], lambda sim: sim.get_envelope('cen_density'))
@@ -0,0 +1,66 @@
+"""
+Multi-resolution min/max/mean summaries of long time series, for plots of whole sweeps.
+
+Level k of an envelope has one bucket per factor**(k+1) points of the original series.
+Each bucket holds the mean of xx and the min, max and mean of yy, so that a plot of
+a few thousand points still shows the full range of the trace:
+
+    xx, yy = env.level(2000)
+    plt.fill_between(xx, yy[:,0], yy[:,1])
+    plt.plot(xx, yy[:,2])
+"""
+from __future__ import division
+
+import numpy as np
+
+class envelope(object):
+    def __init__(self, xx, yy, factor=4, min_points=500):
+        """
+        xx, yy: 1-D arrays of the time series
+        Levels are built until a level has fewer than min_points buckets.
+        """
+        self.factor = factor
+        self.n_raw = len(yy)
+        yy = np.asarray(yy, dtype=float)
+        xx = np.asarray(xx, dtype=float)
+        # xx sum, min, max, yy sum and number of points of each bucket
+        current = (xx, yy, yy, yy, np.ones(len(yy)))
+        self.levels = []
+        if self.n_raw == 0:
+            self.levels.append((xx, np.empty((0, 3))))
+            return
+        while not self.levels or (len(current[1]) > 1 and len(current[1]) >= min_points):
+            current = self._coarsen(current)
+            xx_sum, mins, maxs, sums, counts = current
+            self.levels.append((xx_sum/counts, np.column_stack([mins, maxs, sums/counts])))
+
+    def _coarsen(self, level):
+        starts = np.arange(0, len(level[1]), self.factor)
+        xx_sum, mins, maxs, sums, counts = level
+        return (
+                np.add.reduceat(xx_sum, starts),
+                np.minimum.reduceat(mins, starts),
+                np.maximum.reduceat(maxs, starts),
+                np.add.reduceat(sums, starts),
+                np.add.reduceat(counts, starts),
+                )
+
+    def resolves(self, n_points):
+        """
+        True if level(n_points) has at least n_points buckets. Otherwise, users
+        return the raw series, see simulation_general.time_series.
+        """
+        return n_points <= len(self.levels[0][0])
+
+    def level(self, n_points):
+        """
+        Returns xx and yy of shape (M, 3) with min, max and mean of the coarsest level
+        with at least n_points buckets, or of the finest level if none has as many.
+        """
+        for xx, yy in reversed(self.levels):
+            if len(xx) >= n_points:
+                return xx, yy
+        return self.levels[0]
+
+    def nbytes(self):
+        return sum(xx.nbytes + yy.nbytes for xx, yy in self.levels)
@@ -0,0 +1,478 @@
+"""
+Load and reduce step of 001_create_pickle_pyecloud_results.py.
+It lives in an importable module so that it can be run in worker processes.
+"""
+from __future__ import division
+import os
+import re
+import zlib
+import collections
+import functools
+import itertools
+import multiprocessing
+
+import scipy.io as sio
+import numpy as np
+from scipy.constants import e as const_e
+from scipy.io.matlab.miobase import MatReadError
+
+import mat_stream
+import instrumentation
+import prefetch
+import derived_quantities
+import segment_store
+import results_store
+import compact_hist
+
+const_LHC_frev = 11.2455e3
+
+# Regular expression for the folder names and identifiers of each study type,
+# keyed by the option of 001_create_pickle_pyecloud_results.py that selects it.
+studies = collections.OrderedDict([
+        ('f', ('^Fill(\d+)_cut(\d+\.\d[1-9]*)0*h_\d+GeV_for_triplets_(B[1,2])_LHC_([A-Za-z]+)_\d+GeV_sey([\d\.]+)_coast([\d\.]+)$',
+            ['filln', 'time_of_interest', 'beam', 'device', 'sey', 'coast'])),
+        ('emax', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_Emax_(\d+)',
+            ['device', 'energy', 'sey', 'intensity', 'emax'])),
+        ('s', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_s_param(\d+\.\d+)',
+            ['device', 'energy', 'sey', 'intensity', 's'])),
+        ('musig', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_ctr_(\d+)',
+            ['device', 'energy', 'sey', 'intensity', 'ctr'])),
+        ('mu', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_ctr_(\d\.\d)',
+            ['device', 'energy', 'sey', 'intensity', 'fact_mu'])),
+        ('theta', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_theta_(\d\.\d)',
+            ['device', 'energy', 'sey', 'intensity', 'theta'])),
+        ('r0', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_R0_(\d\.\d)',
+            ['device', 'energy', 'sey', 'intensity', 'r0'])),
+        ('ctr', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_ctr_(\d)',
+            ['device', 'energy', 'sey', 'intensity', 'ctr'])),
+        ('sext', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_([df])',
+            ['device', 'energy', 'sey', 'intensity', 'df'])),
+        ('dipquad', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb',
+            ['device', 'energy', 'sey', 'intensity'])),
+        ('substeps', ('^LHC_([A-Za-z]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_f_substeps_(\d+)',
+            ['device', 'energy', 'sey', 'intensity', 'substeps'])),
+        ('cell', ('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\d)',
+            ['device', 'energy', 'sey', 'intensity', 'photoemission'])),
+        ('energy', ('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\w+)',
+            ['device', 'energy', 'sey', 'intensity', 'distribution'])),
+        ('quad', ('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\d+\.\d)Tpm',
+            ['device', 'energy', 'sey', 'intensity', 'b_field'])),
+        ('multip', ('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_(\d+)',
+            ['device', 'energy', 'sey', 'intensity', 'b_field_id'])),
+        ('mono', ('^LHC_([\w]+)_(\d+)GeV_sey(\d\.\d+)_(\d+\.\d+)e11ppb_mono_(\d+\.\d+)eV',
+            ['device', 'energy', 'sey', 'intensity', 'photoelectron_energy'])),
+        ])
+
+def insert_to_nested_dict(dictionary, value, keys, must_enter=False, add_up=False, overwrite=False):
+    """
+    Inserts value to nested dictionary. The location is specified by keys.
+    If must_enter is set to True, an error is raised if the entry is already present.
+    If overwrite is set to True, an existing entry is replaced.
+    """
+    for key in keys[:-1]:
+        if key not in dictionary:
+            dictionary[key] = {}
+        dictionary = dictionary[key]
+
+    last_key = keys[-1]
+    if last_key not in dictionary:
+        dictionary[last_key] = value
+    elif add_up:
+        dictionary[last_key] += value
+    elif overwrite:
+        dictionary[last_key] = value
+    elif must_enter:
+        raise ValueError('Key %s already exists!' % last_key)
+
+def check_if_already_exist(dictionary, keys):
+    """
+    Returns True if a nested dict with the keys in the correct order does exist.
+    """
+    try:
+        for key in keys:
+            dictionary = dictionary[key]
+    except KeyError:
+        return False
+    else:
+        return True
+
+def list_folders(root_dir):
+    """
+    Names in root_dir, read in one pass. With os.scandir (Python 3.5+), only the directories
+    are returned, which needs no extra stat calls on most file systems.
+    """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        return os.listdir(root_dir)
+    return [entry.name for entry in scandir(root_dir) if entry.is_dir()]
+
+class study_results(object):
+    """
+    The results of one study in output_dir: heat loads, nel_hist, paths, derived quantities,
+    manifest and results store, with the same file names as for a single study.
+    compact: store the nel_hist rows as compact_hist.compact_array
+    """
+    def __init__(self, study, output_dir, compact=False):
+        self.study = study
+        self.compact = compact
+        regex, self.identifiers = studies[study]
+        self.folder_re = re.compile(regex)
+        self.output_dir = output_dir
+        self.hl_pkl_name = output_dir + '/heatload_pyecloud3.pkl'
+        self.nel_hist_pkl_name = output_dir + '/nel_hist_pyecloud3.pkl'
+        self.path_pkl_name = output_dir + '/paths_matfiles_pyecloud.pkl'
+        self.derived_pkl_name = output_dir + '/derived_pyecloud3.pkl'
+        self.manifest_name = output_dir + '/manifest_pyecloud3.pkl'
+        self.store_name = output_dir + '/results_pyecloud3'
+        self.partials_dir = output_dir + '/partials_pyecloud3'
+        self.pkl_names = [self.hl_pkl_name, self.nel_hist_pkl_name, self.path_pkl_name, self.derived_pkl_name, self.manifest_name]
+
+    def load(self, fresh=False, collect_new=False):
+        """
+        fresh: start with empty dicts
+        collect_new: also collect the inserted results in self.new_dicts, for append and write_partial
+        """
+        # Segments merged into the loaded dicts. They are removed when the full pickles are written.
+        self.segments = {pkl_name: segment_store.segment_files(pkl_name) for pkl_name in self.pkl_names}
+        if fresh:
+            self.dicts = {}, {}, {}, {}, {}
+        else:
+            self.dicts = tuple(segment_store.load(pkl_name, self.segments[pkl_name]) for pkl_name in self.pkl_names)
+        self.hl_dict, self.nel_hist_dict, self.path_dict, self.derived_dict, self.manifest = self.dicts
+        self.new_dicts = {}, {}, {}, {}, {}
+        self.all_dicts = [self.dicts, self.new_dicts] if collect_new else [self.dicts]
+
+    def match(self, folder):
+        """
+        Returns the identifier values of folder, or None if it does not belong to this study.
+        """
+        file_info = self.folder_re.search(folder)
+        if file_info is None:
+            return None
+        return list(file_info.groups())
+
+    def is_current(self, folder, keys, state, derived_names=()):
+        """
+        True if the results of folder are unchanged since the last reduction, or its mat file
+        was removed after it.
+        """
+        return (check_if_already_exist(self.hl_dict, keys) and (state is None or self.manifest.get(folder) == state)
+                and all(check_if_already_exist(self.derived_dict.get(name, {}), keys) for name in derived_names))
+
+    def insert(self, folder, keys, mat_str, state, result):
+        """
+        Folders that changed since the last reduction replace their old entries.
+        result: output of reduce_matfile
+        """
+        heatload, e_transverse_hist, xg_hist, derived_values = result
+        # Two folders with the same keys would silently replace each other
+        old_path = self.path_dict
+        for key in keys:
+            old_path = old_path.get(key, {}) if type(old_path) is dict else None
+        if old_path and old_path != mat_str:
+            raise ValueError('Keys %s of %s already exist for %s' % (keys, mat_str, old_path))
+        if self.compact:
+            e_transverse_hist = compact_hist.compact(e_transverse_hist)
+        for hl_dict, nel_hist_dict, path_dict, derived_dict, manifest in self.all_dicts:
+            insert_to_nested_dict(hl_dict, heatload, keys, overwrite=True)
+            insert_to_nested_dict(nel_hist_dict, e_transverse_hist, keys, must_enter=True, overwrite=True)
+            insert_to_nested_dict(path_dict, mat_str, keys, must_enter=True, overwrite=True)
+            for name, value in derived_values.iteritems():
+                insert_to_nested_dict(derived_dict.setdefault(name, {}), value, keys, overwrite=True)
+            manifest[folder] = state
+
+        # add xg_hist variable only once
+        if 'xg_hist' not in self.nel_hist_dict:
+            for dicts in self.all_dicts:
+                insert_to_nested_dict(dicts[1], xg_hist, ['xg_hist'], must_enter=True)
+
+    def _make_output_dir(self):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+    def write(self):
+        """
+        Writes the full pickles and removes the merged segments.
+        """
+        self._make_output_dir()
+        for pkl_name, dict_ in zip(self.pkl_names, self.dicts):
+            if dict_ or pkl_name != self.derived_pkl_name:
+                segment_store.write(pkl_name, dict_, self.segments[pkl_name])
+
+    def append(self):
+        """
+        Writes the collected new results as segments of the pickles and of the results store,
+        and clears them. Returns True if there were any.
+        """
+        if not any(self.new_dicts):
+            return False
+        self._make_output_dir()
+        new_hl, new_nel_hist, new_path = self.new_dicts[:3]
+        if new_hl:
+            store = results_store.results_store.from_dicts(self.identifiers, new_hl, new_nel_hist, new_path)
+            store.append(self.store_name)
+        for pkl_name, new_dict in zip(self.pkl_names, self.new_dicts):
+            segment_store.append(pkl_name, new_dict)
+            new_dict.clear()
+        return True
+
+    def write_partial(self, shard, fail_lines='', fail_lines_IO=''):
+        """
+        Writes the collected new results to the partial result file of shard.
+        """
+        partial = {
+                'shard': shard,
+                'identifiers': self.identifiers,
+                'results': dict(zip(self.pkl_names, self.new_dicts)),
+                'fail_lines': fail_lines,
+                'fail_lines_IO': fail_lines_IO,
+                }
+        if not os.path.isdir(self.partials_dir):
+            os.makedirs(self.partials_dir)
+        segment_store.write(partial_name(self.partials_dir, shard), partial)
+
+    def save_store(self):
+        self._make_output_dir()
+        store = results_store.results_store.from_dicts(self.identifiers, self.hl_dict, self.nel_hist_dict, self.path_dict)
+        store.save(self.store_name, results_store.segment_dirs(self.store_name))
+
+class study_router(object):
+    """
+    Routes every folder to one of several study_results with one match of a combined regex.
+    The study regexes are tried in the order of outputs, the first one that matches wins.
+    full_match: the regexes must match the whole folder name. Most of them only fix the start
+    of the name, so several of them would match e.g. LHC_..._Emax_400.
+    """
+    def __init__(self, outputs, full_match=True):
+        self.outputs = outputs
+        patterns = []
+        for output in outputs:
+            pattern = output.folder_re.pattern.lstrip('^')
+            if full_match and not pattern.endswith('$'):
+                pattern += '$'
+            patterns.append(pattern)
+        # Index of the first identifier group of each study in the combined regex
+        self.group_starts = []
+        n_groups = 0
+        for output in outputs:
+            self.group_starts.append(n_groups + 2)
+            n_groups += 1 + output.folder_re.groups
+        self.regex = re.compile('^(?:%s)' % '|'.join('(?P<study%i>%s)' % item for item in enumerate(patterns)))
+        self.study_res = [re.compile('^' + pattern) for pattern in patterns]
+
+    def route(self, folder):
+        """
+        Returns (study_results, identifier values) of folder, or None.
+        """
+        match = self.regex.match(folder)
+        if match is None:
+            return None
+        # The group of the study encloses its identifier groups, so it closes last
+        ctr = int(match.lastgroup[len('study'):])
+        output = self.outputs[ctr]
+        start = self.group_starts[ctr]
+        return output, [match.group(index) for index in xrange(start, start + output.folder_re.groups)]
+
+    def other_matches(self, folder, output):
+        """
+        Studies after output that folder would also match, for warnings.
+        """
+        ctr = self.outputs.index(output)
+        return [other.study for other, regex in zip(self.outputs, self.study_res)[ctr+1:] if regex.match(folder)]
+
+def parse_shard(spec):
+    """
+    Returns (index, n_shards) from a shard spec 'I/N' with 0 <= I < N.
+    """
+    try:
+        index, n_shards = map(int, spec.split('/'))
+    except ValueError:
+        raise ValueError('Shard spec %s is not of the form I/N' % spec)
+    if not 0 <= index < n_shards:
+        raise ValueError('Shard spec %s needs 0 <= I < N' % spec)
+    return index, n_shards
+
+def in_shard(folder, shard):
+    """
+    Stable assignment of a folder name to one of the shards, the same on every node.
+    """
+    index, n_shards = shard
+    return (zlib.crc32(folder) & 0xffffffff) % n_shards == index
+
+def partial_name(partials_dir, shard):
+    return os.path.join(partials_dir, 'shard_%i_of_%i.pkl' % shard)
+
+# Increase whenever reduce_matfile changes, so that all folders are processed again.
+reduction_version = 1
+
+def mat_file_state(mat_str):
+    """
+    Returns the manifest entry (size, mtime, reduction_version) of mat_str,
+    or None if the file does not exist.
+    """
+    try:
+        stat = os.stat(mat_str)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime, reduction_version
+
+reduce_variables = ['energ_eV_impact_hist', 'nel_hist', 'xg_hist']
+
+def check_matfile(mat_str):
+    """
+    Checks the variable directory of mat_str without reading the data, see mat_stream.scan_directory.
+    Returns None if the file can be reduced, otherwise the reason why not.
+    This finds files of crashed or still running simulations before they are loaded.
+    """
+    try:
+        directory, truncated = mat_stream.scan_directory(mat_str)
+    except (IOError, OSError) as e:
+        return str(e)
+    if truncated:
+        return 'Truncated file'
+    for name in reduce_variables:
+        if name not in directory:
+            return 'Missing variable %s' % name
+        var = directory[name]
+        if not var.is_numeric:
+            return 'Variable %s is not numeric' % name
+        if var.size == 0:
+            return 'Variable %s is empty' % name
+        if var.data_nbytes != var.size*var.stored_dtype.itemsize:
+            return 'Variable %s has %i bytes of data for shape %s' % (name, var.data_nbytes, var.shape)
+    if directory['nel_hist'].shape[1:] != (directory['xg_hist'].size,):
+        return 'Shapes of nel_hist %s and xg_hist %s do not match' % (directory['nel_hist'].shape, directory['xg_hist'].shape)
+    return None
+
+def load_quarantine(filename, segments=None):
+    """
+    The quarantine maps a folder name to (mat_file_state, reason) of a Pyecltest.mat
+    that could not be reduced. The folder is only retried when the state changes.
+    New entries of concurrent runs, e.g. shards, are appended as segments.
+    Folders that were reduced after all have the entry None in later segments.
+    segments: see segment_store.load
+    """
+    quarantine = segment_store.load(filename, segments)
+    return {folder: entry for folder, entry in quarantine.iteritems() if entry is not None}
+
+def is_quarantined(quarantine, folder, state):
+    entry = quarantine.get(folder)
+    return entry is not None and entry[0] == state
+
+def reduce_matfile_streaming(mat_str, chunk_size, derived=()):
+    """
+    Same as reduce_matfile, reading the histograms in chunks of chunk_size elements.
+    Both sum with mat_stream.blockwise_sum, so the results are identical for any chunk_size.
+    """
+    try:
+        with instrumentation.stage('load and reduce'):
+            stream = mat_stream.mat_stream(mat_str, chunk_size)
+            heatload = stream.sum('energ_eV_impact_hist')*const_LHC_frev*const_e
+            e_transverse_hist = stream.sum_columns('nel_hist')
+            xg_hist = stream.read('xg_hist')[0]
+    except IOError:
+        return None
+    instrumentation.record_file(mat_str, sum(stream.directory[name].element_nbytes for name in reduce_variables))
+    derived_values = {}
+    if derived:
+        with instrumentation.stage('derived'):
+            derived_values = derived_quantities.compute_from_matfile(mat_str, derived, streaming=True, chunk_size=chunk_size)
+    return heatload, e_transverse_hist, xg_hist, derived_values
+
+def load_matfile(mat_str, cache=None, derived=()):
+    """
+    Returns the reduce_variables of one Pyecltest.mat file, or None if the file cannot be read.
+    cache: optional sidecar_cache.sidecar_cache
+    derived: names of derived_quantities. Without cache, their variables are read in the same pass.
+    """
+    names = reduce_variables
+    if derived and cache is None:
+        names = names + [name for name in derived_quantities.variables(derived) if name not in names]
+    try:
+        with instrumentation.stage('load'):
+            if cache is None:
+                matfile = sio.loadmat(mat_str, variable_names=names)
+            else:
+                matfile = cache.load(mat_str, names)
+    except (IOError, MatReadError):
+        return None
+    instrumentation.record_file(mat_str, sum(matfile[name].nbytes for name in names if name in matfile))
+    return matfile
+
+def reduce_loaded(matfile, mat_str=None, cache=None, derived=()):
+    """
+    Returns heatload, e_transverse_hist, xg_hist and a dict of the derived quantities
+    from the output of load_matfile.
+    """
+    if matfile is None:
+        return None
+    with instrumentation.stage('reduce'):
+        # Summed like in reduce_matfile_streaming, in column-major order
+        impact_hist = matfile['energ_eV_impact_hist']
+        heatload = mat_stream.blockwise_sum([impact_hist.ravel(order='F')], impact_hist.size)[0]*const_LHC_frev*const_e
+        nel_hist = matfile['nel_hist']
+        e_transverse_hist = mat_stream.blockwise_sum([nel_hist.ravel(order='F')], *nel_hist.shape)
+    derived_values = {}
+    if derived:
+        with instrumentation.stage('derived'):
+            derived_values = derived_quantities.compute_from_matfile(mat_str, derived, matfile, cache)
+    return heatload, e_transverse_hist, matfile['xg_hist'][0], derived_values
+
+def reduce_matfile(mat_str, cache=None, chunk_size=None, derived=()):
+    """
+    Returns heatload, e_transverse_hist, xg_hist and a dict name -> value of the
+    derived_quantities in derived for one Pyecltest.mat file,
+    or None if the file cannot be read.
+    cache: optional sidecar_cache.sidecar_cache
+    chunk_size: if given, use reduce_matfile_streaming
+    """
+    if chunk_size is not None:
+        return reduce_matfile_streaming(mat_str, chunk_size, derived)
+    return reduce_loaded(load_matfile(mat_str, cache, derived), mat_str, cache, derived)
+
+def _reduce_matfile_instrumented(mat_str, cache=None, chunk_size=None, derived=()):
+    """
+    reduce_matfile in a worker process, returning also the instrumentation data of the call.
+    """
+    instrumentation.enable()
+    instrumentation.reset()
+    result = reduce_matfile(mat_str, cache, chunk_size, derived)
+    return result, instrumentation.snapshot()
+
+def reduce_matfiles(mat_strs, jobs=1, cache=None, chunk_size=None, prefetch_depth=0, derived=()):
+    """
+    Generator over reduce_matfile(mat_str, cache, chunk_size, derived) for all mat_strs, in input order.
+    For jobs > 1 the files are processed by a pool of worker processes.
+    Their stage timings are merged into instrumentation if it is enabled,
+    the stage profiler only runs in this process.
+    For jobs <= 1 and prefetch_depth > 0, up to prefetch_depth files are loaded
+    by threads while the current one is reduced. The pool of processes already
+    overlaps loading and reducing, so prefetch_depth is not used for jobs > 1.
+    """
+    if jobs <= 1:
+        if chunk_size is not None:
+            # The streaming reduction reads while it reduces, so whole calls are prefetched
+            for result in prefetch.prefetch(functools.partial(reduce_matfile_streaming, chunk_size=chunk_size, derived=derived),
+                    mat_strs, prefetch_depth):
+                yield result
+        else:
+            matfiles = prefetch.prefetch(functools.partial(load_matfile, cache=cache, derived=derived), mat_strs, prefetch_depth)
+            for mat_str, matfile in itertools.izip(mat_strs, matfiles):
+                yield reduce_loaded(matfile, mat_str, cache, derived)
+        return
+
+    instrumented = instrumentation.enabled
+    func = _reduce_matfile_instrumented if instrumented else reduce_matfile
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(functools.partial(func, cache=cache, chunk_size=chunk_size, derived=derived), mat_strs, chunksize=1):
+            if instrumented:
+                result, data = result
+                instrumentation.merge(data)
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,132 @@
+"""
+Opt-in timers and counters for the stages of ingestion and analysis.
+
+Disabled by default: stage() then returns a shared no-op context manager and
+count() and record_file() return immediately. After enable(), the wall time and
+number of calls of each stage are accumulated, and report() formats them.
+A profiler (cProfile.Profile, or any object with enable() and disable()) can be
+attached to one stage; it is only active inside that stage.
+"""
+from __future__ import division
+import time
+import collections
+
+enabled = False
+stage_times = collections.defaultdict(float)
+stage_calls = collections.defaultdict(int)
+counters = collections.defaultdict(int)
+# Bytes read from each mat file
+file_bytes = collections.defaultdict(int)
+
+profile_stage = None
+profiler = None
+
+class _null_stage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+null_stage = _null_stage()
+
+class _timed_stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if self.name == profile_stage:
+            profiler.enable()
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_times[self.name] += time.time() - self.t0
+        stage_calls[self.name] += 1
+        if self.name == profile_stage:
+            profiler.disable()
+        return False
+
+def stage(name):
+    """
+    Context manager that times the enclosed block as stage name.
+    """
+    if not enabled:
+        return null_stage
+    return _timed_stage(name)
+
+def count(name, value=1):
+    if enabled:
+        counters[name] += value
+
+def record_file(filename, nbytes):
+    if enabled:
+        file_bytes[filename] += nbytes
+
+def enable(stage_name=None, stage_profiler=None):
+    """
+    Starts collecting. If stage_name is given, stage_profiler (default: a new
+    cProfile.Profile) runs inside every call of that stage.
+    """
+    global enabled, profile_stage, profiler
+    enabled = True
+    profile_stage = stage_name
+    if stage_name is not None and stage_profiler is None:
+        import cProfile
+        stage_profiler = cProfile.Profile()
+    profiler = stage_profiler
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    stage_times.clear()
+    stage_calls.clear()
+    counters.clear()
+    file_bytes.clear()
+
+def snapshot():
+    """
+    Returns the collected data as plain dicts, e.g. to send them from a worker process.
+    """
+    return dict(stage_times), dict(stage_calls), dict(counters), dict(file_bytes)
+
+def merge(data):
+    """
+    Adds a snapshot() to the collected data.
+    """
+    for target, source in zip((stage_times, stage_calls, counters, file_bytes), data):
+        for key, value in source.iteritems():
+            target[key] += value
+
+def report():
+    """
+    Returns a table of the stages, counters and bytes read.
+    """
+    lines = ['%-24s %10s %8s %12s' % ('Stage', 'Time [s]', 'Calls', 'Per call [ms]')]
+    for name, dt in sorted(stage_times.items(), key=lambda item: -item[1]):
+        calls = stage_calls[name]
+        lines.append('%-24s %10.3f %8i %12.3f' % (name, dt, calls, dt/calls*1e3))
+    for name, value in sorted(counters.items()):
+        lines.append('%-24s %10s' % (name, value))
+    if file_bytes:
+        sizes = file_bytes.values()
+        lines.append('Read %.1f MB from %i mat files (mean %.2f MB, max %.2f MB per file)' %
+                (sum(sizes)/1e6, len(sizes), sum(sizes)/len(sizes)/1e6, max(sizes)/1e6))
+    return '\n'.join(lines)
+
+def profile_report(sort='cumulative', limit=30):
+    """
+    Returns the pstats output of the stage profiler.
+    """
+    import pstats
+    import StringIO
+    stream = StringIO.StringIO()
+    try:
+        stats = pstats.Stats(profiler, stream=stream)
+    except TypeError:
+        # The stage was never entered in this process
+        return 'No profile data for stage %s' % profile_stage
+    stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
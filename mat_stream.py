@@ -0,0 +1,362 @@
+"""
+Chunked reading of numeric variables from MAT 5 files such as Pyecltest.mat.
+
+read_directory parses only the headers of the variables. mat_stream reads the
+data of a variable in chunks of a fixed number of elements: uncompressed variables
+through np.memmap, compressed ones through an incremental zlib stream.
+Chunks follow the MATLAB (column-major) element order.
+"""
+from __future__ import division
+import os
+import zlib
+import struct
+import collections
+
+import numpy as np
+
+header_size = 128
+miMATRIX = 14
+miCOMPRESSED = 15
+
+# MAT 5 data types
+mi_dtypes = {
+        1: 'i1',
+        2: 'u1',
+        3: 'i2',
+        4: 'u2',
+        5: 'i4',
+        6: 'u4',
+        7: 'f4',
+        9: 'f8',
+        12: 'i8',
+        13: 'u8',
+        }
+
+# MATLAB array classes of numeric arrays
+mx_dtypes = {
+        6: 'f8',
+        7: 'f4',
+        8: 'i1',
+        9: 'u1',
+        10: 'i2',
+        11: 'u2',
+        12: 'i4',
+        13: 'u4',
+        14: 'i8',
+        15: 'u8',
+        }
+
+def _pad8(nbytes):
+    return nbytes + (-nbytes % 8)
+
+def _parse_tag(buf, pos, endian):
+    """
+    Returns type, nbytes, position of the data and position of the next element.
+    """
+    mtype, nbytes = struct.unpack_from(endian+'II', buf, pos)
+    if mtype >> 16:
+        # Small data element: type and size in the first 4 bytes, data in the second 4 bytes
+        return mtype & 0xffff, mtype >> 16, pos+4, pos+8
+    return mtype, nbytes, pos+8, pos+8+_pad8(nbytes)
+
+class mat_variable(object):
+    """
+    Header information of one variable of a MAT 5 file.
+    For compressed variables, data_offset is a position in the decompressed element.
+    """
+    def __init__(self, name, shape, mclass, is_complex, data_type, data_offset, data_nbytes,
+            compressed, element_offset, element_nbytes, endian, truncated):
+        self.name = name
+        self.shape = shape
+        self.mclass = mclass
+        self.is_complex = is_complex
+        self.data_type = data_type
+        self.data_offset = data_offset
+        self.data_nbytes = data_nbytes
+        self.compressed = compressed
+        self.element_offset = element_offset
+        self.element_nbytes = element_nbytes
+        self.endian = endian
+        self.truncated = truncated
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def is_numeric(self):
+        return self.mclass in mx_dtypes and self.data_type in mi_dtypes and not self.is_complex
+
+    @property
+    def stored_dtype(self):
+        return np.dtype(self.endian + mi_dtypes[self.data_type])
+
+    @property
+    def dtype(self):
+        """
+        dtype of the array as returned by scipy.io.loadmat
+        """
+        return np.dtype(mx_dtypes[self.mclass])
+
+def _parse_matrix_header(buf, pos, endian):
+    """
+    pos: position of the first sub-element of a miMATRIX element in buf
+    Returns name, shape, mclass, is_complex, data_type, data_pos, data_nbytes.
+    """
+    _, _, data_pos, pos = _parse_tag(buf, pos, endian)
+    flags = struct.unpack_from(endian+'I', buf, data_pos)[0]
+    mclass = flags & 0xff
+    is_complex = bool(flags & 0x800)
+
+    _, nbytes, data_pos, pos = _parse_tag(buf, pos, endian)
+    shape = struct.unpack_from(endian + 'i'*(nbytes//4), buf, data_pos)
+
+    _, nbytes, data_pos, pos = _parse_tag(buf, pos, endian)
+    name = buf[data_pos:data_pos+nbytes]
+
+    data_type, data_nbytes, data_pos = None, 0, None
+    if mclass in mx_dtypes:
+        data_type, data_nbytes, data_pos, _ = _parse_tag(buf, pos, endian)
+    return name, shape, mclass, is_complex, data_type, data_pos, data_nbytes
+
+def read_endian(header):
+    if len(header) < header_size:
+        raise IOError('Truncated MAT file header')
+    if header[126:128] == 'IM':
+        return '<'
+    elif header[126:128] == 'MI':
+        return '>'
+    raise IOError('Not a MAT 5 file')
+
+def read_directory(filename):
+    """
+    Returns an OrderedDict of name -> mat_variable for the matrices of a MAT 5 file.
+    Only the element headers are read. The scan stops at the first truncated element,
+    which is included with truncated=True.
+    """
+    return scan_directory(filename)[0]
+
+def scan_directory(filename):
+    """
+    Returns read_directory(filename) and whether the file is truncated.
+    """
+    file_size = os.path.getsize(filename)
+    directory = collections.OrderedDict()
+    truncated = False
+    with open(filename, 'rb') as f:
+        endian = read_endian(f.read(header_size))
+        pos = header_size
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            mtype, nbytes = struct.unpack(endian+'II', f.read(8))
+            if mtype == miCOMPRESSED:
+                element_end = pos + 8 + nbytes
+            else:
+                element_end = pos + 8 + _pad8(nbytes)
+            truncated = element_end > file_size
+
+            data_pos = None
+            try:
+                if mtype == miCOMPRESSED:
+                    head = zlib.decompressobj().decompress(f.read(min(nbytes, 4096)), 1024)
+                    inner_type, _ = struct.unpack_from(endian+'II', head, 0)
+                    info = None
+                    if inner_type == miMATRIX:
+                        info = _parse_matrix_header(head, 8, endian)
+                        data_pos = info[5]
+                elif mtype == miMATRIX:
+                    head = f.read(min(nbytes, 1024))
+                    info = _parse_matrix_header(head, 0, endian)
+                    if info[5] is not None:
+                        data_pos = pos + 8 + info[5]
+                else:
+                    info = None
+            except (struct.error, zlib.error):
+                if not truncated:
+                    raise IOError('Corrupt MAT file element at byte %i' % pos)
+                info = None
+
+            if info is not None:
+                name, shape, mclass, is_complex, data_type, _, data_nbytes = info
+                directory[name] = mat_variable(name, shape, mclass, is_complex, data_type, data_pos, data_nbytes,
+                        mtype == miCOMPRESSED, pos+8, nbytes, endian, truncated)
+            if truncated:
+                break
+            pos = element_end
+        truncated = truncated or pos < file_size
+    return directory, truncated
+
+# Elements per block of blockwise_sum, independent of the chunk size
+sum_block = 2**12
+
+def _block_runs(n_rows, n_cols):
+    """
+    Yields (length, count) for the blocks of blockwise_sum, in order: every column is
+    split into blocks of sum_block elements and one shorter block.
+    """
+    n_full, rest = divmod(n_rows, sum_block)
+    if n_full == 0:
+        yield rest, n_cols
+    elif rest == 0:
+        yield sum_block, n_full*n_cols
+    else:
+        for col in xrange(n_cols):
+            yield sum_block, n_full
+            yield rest, 1
+
+def blockwise_sum(chunks, n_rows, n_cols=1):
+    """
+    Column sums of an n_rows x n_cols array, given as 1-D chunks in column-major order.
+    Every column is summed in blocks of sum_block elements, each with np.sum of a new
+    contiguous array, and the block sums are added up in order. The result therefore
+    only depends on the values, not on how they are split into chunks or on the alignment
+    of the array, so that the streaming and the in-memory reduction agree exactly.
+    """
+    if n_rows == 0 or n_cols == 0:
+        return np.zeros(n_cols)
+    block_sums = []
+    data = np.empty(0)
+    pos = 0
+    chunks = iter(chunks)
+    for length, count in _block_runs(n_rows, n_cols):
+        while count:
+            n_blocks = min(count, (len(data) - pos) // length)
+            if n_blocks == 0:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    raise IOError('Fewer than %i elements' % (n_rows*n_cols))
+                if pos == len(data) and chunk.dtype == np.float64 and chunk.flags.aligned and chunk.flags.c_contiguous:
+                    data = chunk
+                else:
+                    # The remaining data and the next chunk, as a new array
+                    data = np.concatenate([data[pos:], chunk])
+                pos = 0
+                continue
+            block_sums.append(np.sum(data[pos:pos+n_blocks*length].reshape(n_blocks, length), axis=1))
+            pos += n_blocks*length
+            count -= n_blocks
+    block_sums = np.concatenate(block_sums).reshape(n_cols, -1)
+    return np.cumsum(block_sums, axis=1)[:,-1]
+
+class mat_stream(object):
+    """
+    Chunked access to the numeric variables of a MAT 5 file.
+    Memory use is bounded by chunk_size elements per open chunk.
+    """
+    def __init__(self, filename, chunk_size=2**20):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.directory, self.truncated = scan_directory(filename)
+
+    def __contains__(self, name):
+        return name in self.directory
+
+    def variable(self, name):
+        if name not in self.directory and self.truncated:
+            raise IOError('Variable %s not found in truncated file %s' % (name, self.filename))
+        var = self.directory[name]
+        if not var.is_numeric:
+            raise ValueError('Variable %s is not a real numeric array' % name)
+        if var.truncated:
+            raise IOError('Variable %s of %s is truncated' % (name, self.filename))
+        return var
+
+    def _iter_decompressed(self, var, block_size=2**20):
+        decompressor = zlib.decompressobj()
+        with open(self.filename, 'rb') as f:
+            f.seek(var.element_offset)
+            remaining = var.element_nbytes
+            while remaining > 0:
+                data = f.read(min(block_size, remaining))
+                if not data:
+                    raise IOError('Unexpected end of %s' % self.filename)
+                remaining -= len(data)
+                while data:
+                    yield decompressor.decompress(data, block_size)
+                    data = decompressor.unconsumed_tail
+
+    def _iter_compressed_chunks(self, var, chunk_size):
+        dtype = var.stored_dtype
+        chunk_nbytes = chunk_size * dtype.itemsize
+        skip = var.data_offset
+        remaining = var.data_nbytes
+        buf = ''
+        for block in self._iter_decompressed(var):
+            if skip:
+                n_skip = min(skip, len(block))
+                block = block[n_skip:]
+                skip -= n_skip
+            block = block[:remaining]
+            remaining -= len(block)
+            buf += block
+            while len(buf) >= chunk_nbytes:
+                yield np.frombuffer(buf[:chunk_nbytes], dtype)
+                buf = buf[chunk_nbytes:]
+            if remaining == 0:
+                break
+        if buf:
+            yield np.frombuffer(buf, dtype)
+
+    def chunks(self, name, chunk_size=None, multiple=1):
+        """
+        Yields the data of name, as 1-D arrays of at most chunk_size elements in column-major order.
+        The chunk size is rounded down to a multiple of multiple.
+        """
+        var = self.variable(name)
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        chunk_size = max(chunk_size // multiple, 1) * multiple
+        dtype = var.dtype
+
+        if var.compressed:
+            for chunk in self._iter_compressed_chunks(var, chunk_size):
+                yield chunk.astype(dtype)
+        else:
+            n_elements = var.data_nbytes // var.stored_dtype.itemsize
+            if n_elements == 0:
+                return
+            data = np.memmap(self.filename, var.stored_dtype, 'r', offset=var.data_offset, shape=(n_elements,))
+            for start in xrange(0, n_elements, chunk_size):
+                yield np.array(data[start:start+chunk_size], dtype=dtype)
+
+    def read(self, name, out=None):
+        """
+        Reads the whole array name (with the shape and dtype of scipy.io.loadmat)
+        without intermediate copies of the full size.
+        """
+        var = self.variable(name)
+        if out is None:
+            out = np.empty(var.size, dtype=var.dtype)
+        start = 0
+        for chunk in self.chunks(name):
+            out[start:start+len(chunk)] = chunk
+            start += len(chunk)
+        return out.reshape(var.shape, order='F')
+
+    def last(self, name):
+        var = self.variable(name)
+        if var.size == 0:
+            raise ValueError('Variable %s is empty' % name)
+        if not var.compressed:
+            offset = var.data_offset + var.data_nbytes - var.stored_dtype.itemsize
+            return np.memmap(self.filename, var.stored_dtype, 'r', offset=offset, shape=(1,))[0]
+        for chunk in self.chunks(name):
+            pass
+        return chunk[-1]
+
+    def sum(self, name):
+        """
+        Sum of all elements of name, see blockwise_sum.
+        It agrees with np.sum of the loaded array up to rounding in the last bits.
+        """
+        var = self.variable(name)
+        return blockwise_sum(self.chunks(name), var.size)[0]
+
+    def sum_columns(self, name):
+        """
+        Column sums of a 2-D variable, see blockwise_sum.
+        """
+        var = self.variable(name)
+        n_rows, n_cols = var.shape
+        return blockwise_sum(self.chunks(name), n_rows, n_cols)
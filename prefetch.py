@@ -0,0 +1,85 @@
+"""
+Bounded read-ahead of slow calls, such as loading mat files from network storage,
+in a pool of threads. While the consumer works on one result, the next ones are
+already being loaded. File reads, zlib decompression and most numpy operations
+release the GIL, so threads are enough to overlap them.
+"""
+import sys
+import threading
+import collections
+import Queue
+
+class _pending(object):
+    """
+    Result of one call, filled in by a worker thread.
+    """
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.func(self.item)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+def _worker(tasks):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task.run()
+
+def prefetch(func, items, depth=4, threads=None):
+    """
+    Generator over func(item) for all items, in input order.
+    At most depth calls are running or waiting to be consumed at any time, so
+    the memory use is bounded by depth results. threads defaults to depth.
+    An exception of func is raised when its result is reached.
+    For depth <= 0, the calls are made one by one in the consumer thread.
+    """
+    if depth <= 0:
+        for item in items:
+            yield func(item)
+        return
+
+    tasks = Queue.Queue()
+    workers = [threading.Thread(target=_worker, args=(tasks,)) for _ in xrange(threads or depth)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    def stop():
+        for _ in workers:
+            tasks.put(None)
+
+    pending = collections.deque()
+    try:
+        for item in items:
+            task = _pending(func, item)
+            tasks.put(task)
+            pending.append(task)
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        # The workers exit after the queued calls, even if the last results are never consumed
+        stop()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Calls that were not started yet are dropped
+        while True:
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                break
+        stop()
@@ -0,0 +1,336 @@
+"""
+Local server that keeps result pickles and simulations in memory for several sessions.
+
+Start it once per machine:
+    python results_server.py --socket /tmp/pyecloud_results.sock --root /path/to/studies
+and pass the socket to heatload_study, whose methods are then answered by the server:
+    hl_study = ss.heatload_study('heatload_pyecloud3.pkl', identifiers, server='/tmp/pyecloud_results.sock')
+
+The server only loads pickles under the --root directories. It loads every pickle once, reloads it when its mtime changes, and keeps the
+simulations of create_lists_path in simulation_study.sim_cache. Requests are sent as JSON
+and replies are pickled. Numeric arrays of at least shm_bytes are written to a file in
+/dev/shm that the client maps with np.memmap, so that they are copied only once and not
+serialized. The server removes these files when the client acknowledges the reply.
+The socket and the files can only be used by the user of the server, as the pickles
+it loads and the input files near the mat files can execute code.
+"""
+from __future__ import print_function
+import os
+import sys
+import struct
+import socket
+import tempfile
+import argparse
+import itertools
+import threading
+import signal
+import SocketServer
+import cPickle
+import json
+
+import numpy as np
+
+import simulation_study
+import segment_store
+
+default_socket = os.path.join(tempfile.gettempdir(), 'pyecloud_results.sock')
+shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+shm_bytes = 2**20
+
+# Methods of heatload_study that clients can call, and attributes they can read
+methods = ('create_lists', 'create_lists_beams', 'create_lists_sum', 'create_grid', 'create_lists_path',
+        'create_lists_derived', 'create_lists_batch', 'query', 'get_first_entry')
+attributes = ('id_keys',)
+
+_header = struct.Struct('!Q')
+_counter = itertools.count()
+# Sent by the client when it has mapped the arrays of a reply
+_ack = 'ack'
+
+def _send_bytes(sock, data):
+    sock.sendall(_header.pack(len(data)) + data)
+
+def _send(sock, obj):
+    _send_bytes(sock, cPickle.dumps(obj, -1))
+
+def _to_json(value):
+    """
+    Encodes the numpy arguments of a request, which json cannot serialize.
+    """
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': value.dtype.str, 'shape': value.shape}
+    if isinstance(value, np.generic):
+        return {'__numpy__': value.item(), 'dtype': value.dtype.str}
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def _decode_numpy(dict_):
+    if '__ndarray__' in dict_:
+        return np.array(dict_['__ndarray__'], dtype=str(dict_['dtype'])).reshape(dict_['shape'])
+    if '__numpy__' in dict_:
+        return np.dtype(str(dict_['dtype'])).type(dict_['__numpy__'])
+    return dict_
+
+def _send_json(sock, obj):
+    _send_bytes(sock, json.dumps(obj, default=_to_json))
+
+def _recv_exactly(sock, nbytes):
+    chunks = []
+    while nbytes:
+        chunk = sock.recv(min(nbytes, 2**20))
+        if not chunk:
+            raise IOError('Connection closed by results server')
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return ''.join(chunks)
+
+def _recv_bytes(sock):
+    nbytes, = _header.unpack(_recv_exactly(sock, _header.size))
+    return _recv_exactly(sock, nbytes)
+
+def _from_json(value):
+    """
+    Unicode strings to str, as the heatload_study methods expect.
+    """
+    if type(value) is unicode:
+        return str(value)
+    if type(value) is list:
+        return [_from_json(item) for item in value]
+    if type(value) is dict:
+        return {str(key): _from_json(item) for key, item in value.iteritems()}
+    return value
+
+def _recv_json(sock):
+    return _from_json(json.loads(_recv_bytes(sock), object_hook=_decode_numpy))
+
+class shm_array(object):
+    """
+    Placeholder for an array that was written to filename.
+    """
+    def __init__(self, filename, dtype, shape):
+        self.filename = filename
+        self.dtype = dtype
+        self.shape = shape
+
+    def open(self):
+        """
+        Maps the array copy-on-write. The mapping stays valid when the server removes the file.
+        """
+        return np.memmap(self.filename, dtype=self.dtype, mode='c', shape=self.shape)
+
+def to_shm(value, filenames):
+    """
+    Replaces the large numeric arrays in value, also inside tuples, lists and object arrays, by shm_arrays.
+    The names of the written files are appended to filenames, also if an error occurs.
+    """
+    if type(value) in (tuple, list):
+        return type(value)(to_shm(item, filenames) for item in value)
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            output = np.empty(value.shape, dtype=object)
+            for index, item in np.ndenumerate(value):
+                output[index] = to_shm(item, filenames)
+            return output
+        if value.nbytes >= shm_bytes and value.dtype.kind in 'biuf':
+            filename = os.path.join(shm_dir, 'pyecloud_results_%i_%i.npy' % (os.getpid(), next(_counter)))
+            filenames.append(filename)
+            # Created readable by the user only, and never through an existing file or link
+            with os.fdopen(os.open(filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600), 'w+b') as f:
+                np.memmap(f, dtype=value.dtype, mode='w+', shape=value.shape)[...] = value
+            return shm_array(filename, value.dtype, value.shape)
+    return value
+
+def remove_files(filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def from_shm(value):
+    """
+    Inverse of to_shm.
+    """
+    if isinstance(value, shm_array):
+        return value.open()
+    if type(value) in (tuple, list):
+        return type(value)(from_shm(item) for item in value)
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        for index, item in np.ndenumerate(value):
+            value[index] = from_shm(item)
+    return value
+
+def _file_state(filename):
+    """
+    mtime of a pickle, its segments or a results_store directory, to detect updates.
+    """
+    if filename is None:
+        return None
+    times = [os.path.getmtime(filename)]
+    for segment in segment_store.segment_files(filename):
+        times.append(os.path.getmtime(segment))
+    # Also changes when a segment of a results_store is added or removed
+    if os.path.isdir(segment_store.segment_dir(filename)):
+        times.append(os.path.getmtime(segment_store.segment_dir(filename)))
+    return tuple(times)
+
+class results_server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, roots, socket_path=default_socket):
+        """
+        roots: directories with the pickles and results stores that are served
+        """
+        if os.path.exists(socket_path):
+            # Left over from a server that did not shut down cleanly
+            try:
+                client(socket_path).ping()
+            except socket.error:
+                os.remove(socket_path)
+            else:
+                raise IOError('A results server is already running on %s' % socket_path)
+        # Only the user of the server can connect
+        old_umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path, _handler)
+        finally:
+            os.umask(old_umask)
+        self.socket_path = socket_path
+        self.roots = [os.path.join(os.path.realpath(root), '') for root in roots]
+        # (pkl_file, identifiers, column, derived) -> (file states, heatload_study)
+        self.studies = {}
+        self._lock = threading.Lock()
+        # Files of the replies that are not acknowledged yet, removed on shutdown
+        self.pending = {}
+
+    def get_study(self, spec):
+        spec = tuple(tuple(item) if type(item) is list else item for item in spec)
+        pkl_file, identifiers, column, derived = spec
+        for filename in (pkl_file, derived):
+            if filename is not None and not self.is_served(filename):
+                raise ValueError('%s is not in a served directory' % filename)
+        state = _file_state(pkl_file), _file_state(derived)
+        with self._lock:
+            entry = self.studies.get(spec)
+            if entry is None or entry[0] != state:
+                study = simulation_study.heatload_study(pkl_file, list(identifiers), column=column, derived=derived)
+                entry = self.studies[spec] = state, study
+        return entry[1]
+
+    def is_served(self, filename):
+        filename = os.path.realpath(filename)
+        return any(filename.startswith(root) for root in self.roots)
+
+    def answer(self, request):
+        spec, name, args, kwargs = request
+        if name == 'ping':
+            return None
+        study = self.get_study(spec)
+        if name in attributes:
+            return getattr(study, name)
+        if name not in methods:
+            raise ValueError('Method %s is not served' % name)
+        return getattr(study, name)(*args, **kwargs)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        for filenames in self.pending.values():
+            remove_files(filenames)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+class _handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = _recv_json(self.request)
+            except (IOError, socket.error, ValueError):
+                return
+            filenames = []
+            self.server.pending[id(filenames)] = filenames
+            try:
+                try:
+                    reply = True, to_shm(self.server.answer(request), filenames)
+                except Exception as e:
+                    try:
+                        cPickle.dumps(e, -1)
+                    except Exception:
+                        e = RuntimeError(repr(e))
+                    reply = False, e
+                try:
+                    _send(self.request, reply)
+                    if _recv_json(self.request) != _ack:
+                        return
+                except (IOError, socket.error, ValueError):
+                    return
+            finally:
+                remove_files(filenames)
+                del self.server.pending[id(filenames)]
+
+class client(object):
+    """
+    Connection to a results_server, one per thread.
+    """
+    def __init__(self, socket_path=default_socket):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def call(self, spec, name, *args, **kwargs):
+        """
+        spec, args and kwargs are sent as JSON, numpy arrays and scalars included. Tuples arrive as lists.
+        """
+        sock = self._socket()
+        try:
+            _send_json(sock, (spec, name, args, kwargs))
+            data = _recv_bytes(sock)
+            try:
+                ok, value = cPickle.loads(data)
+                if ok:
+                    value = from_shm(value)
+            finally:
+                # The server removes the files of the reply now
+                _send_json(sock, _ack)
+        except (IOError, socket.error):
+            sock.close()
+            self._local.sock = None
+            raise
+        if not ok:
+            raise value
+        return value
+
+    def ping(self):
+        return self.call(None, 'ping')
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves heatload_study queries from memory over a Unix socket.')
+    parser.add_argument('--socket', help='Socket path. Default: %s.' % default_socket, default=default_socket)
+    parser.add_argument('--root', help='Directory with pickles or results stores to serve, also in subdirectories. Can be given several times.',
+            action='append', required=True, metavar='DIR')
+    parser.add_argument('--max-mb', help='Size limit of the cached simulations in MB. Default: %i.' % (simulation_study.sim_cache.max_bytes/1e6), type=float)
+    args = parser.parse_args()
+
+    if args.max_mb is not None:
+        simulation_study.sim_cache.max_bytes = args.max_mb*1e6
+    server = results_server(args.root, args.socket)
+    # Shut down cleanly on kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Serving on %s' % args.socket)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    # The replies must reference results_server.shm_array, not __main__.shm_array
+    import results_server
+    results_server.main()
@@ -0,0 +1,298 @@
+"""
+Columnar storage of the pyecloud results, as an alternative to the nested dict pickles.
+
+There is one row per simulation. Every identifier is a string column, the heat load
+and the path are columns and the nel_hist rows form one 2-D array.
+Each column is saved as a .npy file in a directory, so it can be memory-mapped.
+
+New rows can be appended as segments, which are stores of their own in
+<directory>.segments/, like the segments of segment_store. load merges them into
+the main store, later rows replace earlier rows with the same identifiers.
+"""
+from __future__ import division
+import os
+import json
+import shutil
+
+import numpy as np
+
+import utils
+import compact_hist
+import segment_store
+
+meta_name = 'meta.json'
+
+def segment_dirs(directory):
+    """
+    Returns the segments of the store in directory, oldest first.
+    """
+    seg_dir = segment_store.segment_dir(directory)
+    if not os.path.isdir(seg_dir):
+        return []
+    return [os.path.join(seg_dir, name) for name in sorted(os.listdir(seg_dir)) if not name.endswith('.tmp')]
+
+def _to_float(arr):
+    try:
+        return np.array(arr, dtype=float)
+    except ValueError:
+        return arr
+
+class results_store(object):
+    def __init__(self, identifiers, columns, xg_hist=None):
+        """
+        identifiers: names of the identifier columns, in folder order
+        columns: dict of column name -> array, all with the same number of rows
+        """
+        self.identifiers = list(identifiers)
+        self.columns = columns
+        self.xg_hist = xg_hist
+
+    def __len__(self):
+        return len(self.columns[self.identifiers[0]])
+
+    @classmethod
+    def from_dicts(cls, identifiers, hl_dict, nel_hist_dict=None, path_dict=None):
+        """
+        Builds the table from the nested dicts of 001_create_pickle_pyecloud_results.py.
+        The rows are the entries of hl_dict. Missing paths are empty strings and
+        missing nel_hist rows are NaN.
+        """
+        depth = len(identifiers)
+        items = sorted(utils.flatten_nested_dict(hl_dict, depth))
+        keys = [item[0] for item in items]
+
+        columns = {}
+        for ctr, identifier in enumerate(identifiers):
+            columns[identifier] = np.array([key[ctr] for key in keys], dtype=str)
+        columns['heatload'] = np.array([item[1] for item in items], dtype=float)
+
+        path_lookup = dict(utils.flatten_nested_dict(path_dict or {}, depth))
+        columns['path'] = np.array([path_lookup.get(key, '') for key in keys], dtype=str)
+
+        xg_hist = None
+        if nel_hist_dict:
+            xg_hist = nel_hist_dict.get('xg_hist')
+            hist_lookup = dict(utils.flatten_nested_dict(nel_hist_dict, depth))
+            n_bins = max([len(hist) for hist in hist_lookup.itervalues()] or [0])
+            nel_hist = np.empty((len(keys), n_bins), dtype=float)
+            nel_hist.fill(np.nan)
+            for row, key in enumerate(keys):
+                if key in hist_lookup:
+                    hist = hist_lookup[key]
+                    nel_hist[row,:len(hist)] = compact_hist.dense(hist)
+            columns['nel_hist'] = nel_hist
+
+        return cls(identifiers, columns, xg_hist)
+
+    def save(self, directory, segments=()):
+        """
+        segments: see segment_dirs. They are removed after the store is written, so they must be included in it.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        columns = self.columns.copy()
+        if self.xg_hist is not None:
+            columns['xg_hist'] = np.asarray(self.xg_hist)
+        for name, arr in columns.iteritems():
+            filename = os.path.join(directory, name + '.npy')
+            np.save(filename + '.tmp.npy', arr)
+            os.rename(filename + '.tmp.npy', filename)
+
+        meta = {
+                'identifiers': self.identifiers,
+                'columns': sorted(self.columns.keys()),
+                'xg_hist': self.xg_hist is not None,
+                }
+        meta_file = os.path.join(directory, meta_name)
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(meta_file + '.tmp', meta_file)
+        for segment in segments:
+            shutil.rmtree(segment)
+
+    def append(self, directory):
+        """
+        Saves the rows of this store as a new segment of the store in directory,
+        or as the store itself if there is none yet.
+        """
+        if not os.path.isfile(os.path.join(directory, meta_name)):
+            self.save(directory)
+            return
+        segment = segment_store.new_segment(directory)
+        self.save(segment + '.tmp')
+        os.rename(segment + '.tmp', segment)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Returns one store with the rows of stores, sorted like in from_dicts.
+        Rows of later stores replace the rows of earlier ones with the same identifiers.
+        """
+        identifiers = stores[0].identifiers
+        # Identifier values -> (store index, row) of the last store with them
+        rows = {}
+        for store_ctr, store in enumerate(stores):
+            id_cols = [store.columns[identifier] for identifier in identifiers]
+            for row in xrange(len(store)):
+                rows[tuple(col[row] for col in id_cols)] = store_ctr, row
+        sources = [rows[key] for key in sorted(rows)]
+        store_index = np.array([source[0] for source in sources], dtype=int)
+        row_index = np.array([source[1] for source in sources], dtype=int)
+
+        columns = {}
+        for name in set(name for store in stores for name in store.columns):
+            cols = [store.columns.get(name) for store in stores]
+            present = [col for col in cols if col is not None]
+            # Missing values as in from_dicts, also for nel_hist rows with fewer bins
+            shape = (len(sources),) + tuple(np.max([col.shape[1:] for col in present], axis=0))
+            column = np.empty(shape, dtype=np.result_type(*present))
+            column.fill('' if column.dtype.kind == 'S' else np.nan)
+            for store_ctr, col in enumerate(cols):
+                if col is not None:
+                    target = np.flatnonzero(store_index == store_ctr)
+                    column[(target,) + tuple(slice(0, n) for n in col.shape[1:])] = col[row_index[target]]
+            columns[name] = column
+
+        xg_hist = [store.xg_hist for store in stores if store.xg_hist is not None]
+        return cls(identifiers, columns, xg_hist[0] if xg_hist else None)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        The columns are memory-mapped unless mmap_mode is None, or there are segments to merge.
+        """
+        store = cls._load(directory, mmap_mode)
+        segments = segment_dirs(directory)
+        if not segments:
+            return store
+        return cls.concatenate([store] + [cls._load(segment, mmap_mode) for segment in segments])
+
+    @classmethod
+    def _load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, meta_name)) as f:
+            meta = json.load(f)
+        columns = {}
+        for name in meta['columns']:
+            columns[str(name)] = np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+        xg_hist = None
+        if meta['xg_hist']:
+            xg_hist = np.load(os.path.join(directory, 'xg_hist.npy'))
+        return cls(map(str, meta['identifiers']), columns, xg_hist)
+
+    def id_keys(self):
+        """
+        Same as utils.id_keys, but with all values of each identifier.
+        """
+        return {identifier: sorted(np.unique(self.columns[identifier])) for identifier in self.identifiers}
+
+    def mask(self, **selection):
+        """
+        Boolean row mask for identifier=value pairs. A value can also be a list of allowed values.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for identifier, value in selection.iteritems():
+            col = self.columns[identifier]
+            if type(value) in (list, tuple, np.ndarray):
+                mask &= np.in1d(col, map(str, value))
+            else:
+                mask &= col == str(value)
+        return mask
+
+    def _valid_rows(self, column, index):
+        """
+        Removes the rows of index for which column has no entry.
+        """
+        if column == 'nel_hist':
+            return index[~np.isnan(self.columns[column][index,0])]
+        elif column == 'path':
+            return index[self.columns[column][index] != '']
+        return index
+
+    def query(self, x, column='heatload', convert_array=True, **selection):
+        """
+        Returns xx, yy for all rows that match selection (see mask), sorted by xx.
+        x: identifier used for xx
+        column: column used for yy
+        """
+        index = self._valid_rows(column, np.flatnonzero(self.mask(**selection)))
+        xx = self.columns[x][index]
+        if convert_array:
+            xx = _to_float(xx)
+        order = np.argsort(xx, kind='mergesort')
+        index = index[order]
+        yy = self.columns[column][index]
+        if convert_array:
+            yy = _to_float(yy)
+        return xx[order], yy
+
+    def create_lists(self, var_arr, column='heatload', convert_array=True, expert=False):
+        """
+        Same call style and output as utils.create_lists on the nested dict of column.
+        var_arr with one entry per identifier and one 'VAR' is answered from the columns.
+        Other call styles, like a var_arr shorter than the identifiers, go through to_nested_dict.
+        """
+        var_arr = map(str, var_arr)
+        if len(var_arr) != len(self.identifiers) or var_arr.count('VAR') != 1:
+            return utils.create_lists(self.to_nested_dict(column), var_arr, convert_array, expert)
+
+        selection = {}
+        for identifier, var in zip(self.identifiers, var_arr):
+            if var not in ('VAR', 'PASS'):
+                selection[identifier] = var
+        index = self._valid_rows(column, np.flatnonzero(self.mask(**selection)))
+
+        x_col = self.columns[self.identifiers[var_arr.index('VAR')]]
+        keys, first = np.unique(x_col[index], return_index=True)
+        if len(keys) != len(index) and not expert:
+            print(var_arr)
+            raise ValueError('Illegal use of PASS')
+        if len(keys) == 0:
+            print(var_arr)
+            raise ValueError('Empty xx')
+
+        xx = keys
+        yy = self.columns[column][index[first]]
+        if convert_array:
+            xx = _to_float(xx)
+            yy = _to_float(yy)
+        else:
+            xx, yy = list(xx), list(yy)
+        return xx, yy
+
+    def create_grid(self, var_arr, column='heatload', convert_array=True, expert=False):
+        """
+        Same as utils.create_grid on the nested dict of column.
+        """
+        index = self._valid_rows(column, np.arange(len(self)))
+        columns = [self.columns[identifier][index] for identifier in self.identifiers]
+        return utils.create_grid_from_index(columns, self.columns[column][index], var_arr, convert_array, expert)
+
+    def create_lists_sum(self, var_arr, placeholder, values, column='heatload'):
+        """
+        Same as utils.create_lists_sum.
+        """
+        series = []
+        for value in values:
+            this_var_arr = list(var_arr)
+            this_var_arr[this_var_arr.index(placeholder)] = value
+            series.append(self.create_lists(this_var_arr, column))
+        return utils.add_up_series(series)
+
+    def create_lists_beams(self, var_arr, column='heatload'):
+        return self.create_lists_sum(var_arr, 'BEAMS', ['B1', 'B2'], column)
+
+    def to_nested_dict(self, column='heatload'):
+        """
+        Inverse of from_dicts for one column.
+        """
+        dict_ = {}
+        values = self.columns[column]
+        id_cols = [self.columns[identifier] for identifier in self.identifiers]
+        for row in self._valid_rows(column, np.arange(len(self))):
+            dd = dict_
+            for col in id_cols[:-1]:
+                dd = dd.setdefault(col[row], {})
+            dd[id_cols[-1][row]] = values[row]
+        if column == 'nel_hist' and self.xg_hist is not None:
+            dict_['xg_hist'] = self.xg_hist
+        return dict_
@@ -0,0 +1,93 @@
+"""
+Append-only segments for the result pickles of 001_create_pickle_pyecloud_results.py.
+
+New results are written as small pickles into <pkl_file>.segments/ instead of
+rewriting the full pickle. Readers merge the segments into the main pickle in
+the order they were written, later entries replace earlier ones. write replaces
+the main pickle by the merged dict and removes the merged segments.
+
+All files are written to a temporary name and renamed, so readers never see a
+partial file. A crash during write leaves segments that are already part of the
+main pickle, which merge to the same result. write only removes the segments it
+is given, so it can run while new segments are appended.
+"""
+import os
+import time
+import itertools
+import cPickle
+
+suffix = '.segments'
+_counter = itertools.count()
+
+def segment_dir(pkl_file):
+    return pkl_file + suffix
+
+def segment_files(pkl_file):
+    """
+    Returns the segments of pkl_file, oldest first.
+    """
+    directory = segment_dir(pkl_file)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.pkl')]
+
+def _dump(dict_, filename):
+    tmp_file = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmp_file, 'w') as f:
+        cPickle.dump(dict_, f, -1)
+    os.rename(tmp_file, filename)
+
+def _load(filename):
+    with open(filename) as f:
+        return cPickle.load(f)
+
+def merge(dict_, update):
+    """
+    Recursively inserts the entries of the nested dict update into dict_.
+    """
+    for key, value in update.iteritems():
+        if type(value) is dict and type(dict_.get(key)) is dict:
+            merge(dict_[key], value)
+        else:
+            dict_[key] = value
+    return dict_
+
+def append(pkl_file, dict_):
+    """
+    Writes the nested dict dict_ as a new segment of pkl_file. Empty dicts are not written.
+    """
+    if not dict_:
+        return None
+    filename = new_segment(pkl_file) + '.pkl'
+    _dump(dict_, filename)
+    return filename
+
+def new_segment(pkl_file):
+    """
+    Returns a new segment path of pkl_file, without extension, and creates the segment directory.
+    """
+    directory = segment_dir(pkl_file)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Fixed width, so that the names sort in the order of writing
+    return os.path.join(directory, '%017.6f-%08i-%06i' % (time.time(), os.getpid(), next(_counter)))
+
+def load(pkl_file, segments=None):
+    """
+    Returns the main pickle (or {} if it does not exist) merged with segments
+    (default: all current segments of pkl_file).
+    """
+    if segments is None:
+        segments = segment_files(pkl_file)
+    dict_ = _load(pkl_file) if os.path.isfile(pkl_file) else {}
+    for segment in segments:
+        merge(dict_, _load(segment))
+    return dict_
+
+def write(pkl_file, dict_, segments=()):
+    """
+    Replaces the main pickle by dict_, then removes segments, which must be included in dict_.
+    """
+    _dump(dict_, pkl_file)
+    for segment in segments:
+        os.remove(segment)
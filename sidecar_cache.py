@@ -0,0 +1,167 @@
+"""
+Opt-in cache of Pyecltest.mat variables in uncompressed .npy sidecar files.
+A cached variable is opened with np.load(mmap_mode='r') instead of decoding the mat file again.
+
+Usage:
+    import utils, sidecar_cache
+    utils.mat_cache = sidecar_cache.sidecar_cache(max_bytes=10e9)
+"""
+from __future__ import division
+import os
+import json
+import errno
+import hashlib
+
+import numpy as np
+import scipy.io as sio
+
+meta_name = 'meta.json'
+# Suffix of sidecar files that are still being written
+tmp_suffix = '.tmp.npy'
+
+def _remove(filename):
+    """
+    Removes filename, unless another process already did.
+    """
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _load_npy(npy_file):
+    """
+    Returns the memory-mapped sidecar file, or None if it was removed, e.g. by
+    the eviction of another process.
+    """
+    try:
+        arr = np.load(npy_file, mmap_mode='r')
+        # The mtime of a sidecar file marks its last use for the eviction
+        os.utime(npy_file, None)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return arr
+
+def file_state(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+class sidecar_cache(object):
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+        cache_dir: If None, the sidecar files of a mat file are stored in <mat file>.cache/.
+            Otherwise they are stored in a subdirectory of cache_dir.
+        max_bytes: Size limit for cache_dir, or for each sidecar directory if cache_dir is None.
+            The least recently used arrays are removed when it is exceeded.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def sidecar_dir(self, mat_file):
+        mat_file = os.path.abspath(mat_file)
+        if self.cache_dir is None:
+            return mat_file + '.cache'
+        return os.path.join(self.cache_dir, hashlib.sha1(mat_file).hexdigest())
+
+    def _read_meta(self, directory):
+        try:
+            with open(os.path.join(directory, meta_name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_meta(self, directory, meta):
+        meta_file = os.path.join(directory, meta_name)
+        tmp_file = '%s.%i.tmp' % (meta_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_file, meta_file)
+
+    def invalidate(self, mat_file):
+        directory = self.sidecar_dir(mat_file)
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name.endswith('.npy') and not name.endswith(tmp_suffix):
+                _remove(os.path.join(directory, name))
+
+    def load(self, mat_file, names):
+        """
+        Returns a dict with the variables names of mat_file as memory-mapped arrays.
+        Variables that are not cached yet are read from mat_file in one pass and written to the cache.
+        The cache of mat_file is cleared if its size or mtime changed.
+        Sidecar files that are removed by other processes while this runs count as not cached.
+        """
+        directory = self.sidecar_dir(mat_file)
+        state = file_state(mat_file)
+        meta = self._read_meta(directory)
+        if meta.get('state') != state:
+            self.invalidate(mat_file)
+            meta = {'source': os.path.abspath(mat_file), 'state': state}
+
+        output = {}
+        missing = []
+        for name in names:
+            arr = None
+            npy_file = os.path.join(directory, name + '.npy')
+            if os.path.isfile(npy_file):
+                arr = _load_npy(npy_file)
+            if arr is not None:
+                output[name] = arr
+            else:
+                missing.append(name)
+
+        if missing:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            mat = sio.loadmat(mat_file, variable_names=missing)
+            for name in missing:
+                if name not in mat:
+                    raise KeyError(name)
+                arr = mat[name]
+                if arr.dtype.hasobject:
+                    # Cannot be memory-mapped
+                    output[name] = arr
+                    continue
+                npy_file = os.path.join(directory, name + '.npy')
+                tmp_file = '%s.%i%s' % (npy_file, os.getpid(), tmp_suffix)
+                np.save(tmp_file, arr)
+                os.rename(tmp_file, npy_file)
+                mapped = _load_npy(npy_file)
+                output[name] = arr if mapped is None else mapped
+            self._write_meta(directory, meta)
+            self.evict(directory)
+
+        return output
+
+    def evict(self, directory=None):
+        """
+        Removes the least recently used arrays until the cache is smaller than max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        if self.cache_dir is not None:
+            directory = self.cache_dir
+
+        npy_files = []
+        for dirpath, _, filenames in os.walk(directory):
+            for name in filenames:
+                if name.endswith('.npy') and not name.endswith(tmp_suffix):
+                    filename = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError as e:
+                        # Removed by another process
+                        if e.errno != errno.ENOENT:
+                            raise
+                        continue
+                    npy_files.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in npy_files)
+        for _, size, filename in sorted(npy_files):
+            if total <= self.max_bytes:
+                break
+            _remove(filename)
+            total -= size
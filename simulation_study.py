@@ -1,66 +1,357 @@
 from __future__ import division
 import os
+import hashlib
+import threading
+import collections
+import cPickle
 
-import scipy.io as sio
-from scipy.constants import e, c
 import numpy as np
 
 import utils
-
-import HeatLoadCalculators.impedance_heatload as hli
-import HeatLoadCalculators.synchrotron_radiation_heatload as hls
-
-imp_calc = hli.HeatLoadCalculatorImpedanceLHCArc()
-sr_calc = hls.HeatLoadCalculatorSynchrotronRadiationLHCArc()
+import results_store
+import mat_stream
+import instrumentation
+import prefetch
+import envelope
+
+# scipy.constants and the HeatLoadCalculators are imported on first use,
+# as they dominate the import time of this module.
+_calculators = None
+
+def get_calculators():
+    """
+    Returns the impedance and synchrotron radiation heat load calculators,
+    which are created on the first call.
+    """
+    global _calculators
+    if _calculators is None:
+        import HeatLoadCalculators.impedance_heatload as hli
+        import HeatLoadCalculators.synchrotron_radiation_heatload as hls
+        _calculators = hli.HeatLoadCalculatorImpedanceLHCArc(), hls.HeatLoadCalculatorSynchrotronRadiationLHCArc()
+    return _calculators
+
+def scipy_constant(name):
+    from scipy import constants
+    return getattr(constants, name)
 
 const_LHC_frev = 11.2455e3
 const_len_cryogenic_cell = 53.45
 
+def _array_or_objects(values):
+    """
+    np.array(values), or a 1-D object array if the values have different shapes,
+    like (xx, yy) tuples with a 2-D yy.
+    """
+    try:
+        return np.array(values)
+    except ValueError:
+        output = np.empty(len(values), dtype=object)
+        for ctr, value in enumerate(values):
+            output[ctr] = value
+        return output
+
 class heatload_study(object):
-    def __init__(self, pkl_file, identifiers, title=None):
+    def __init__(self, pkl_file, identifiers, title=None, column='heatload', derived=None, server=None):
         """
         pkl_file, identifiers, title
+        pkl_file can also be a results_store or its directory. In that case,
+        column is the results_store column used for the values.
+        derived: derived_pyecloud3.pkl or its dict, written by the ingestion script with --derived.
+        create_lists_path then returns the stored quantities instead of reading the mat files.
+        server: socket path or results_server.client. The queries are then answered by a
+        results_server, which keeps pkl_file and derived (both file names) in memory.
         """
-        if type(pkl_file) is str:
+        self.store = None
+        self.server = None
+        self.title = title
+        self._key_index = None
+        if server is not None:
+            import results_server
+            if type(pkl_file) is not str or (derived is not None and type(derived) is not str):
+                raise ValueError('With a server, pkl_file and derived must be file names')
+            if type(server) is str:
+                server = results_server.client(server)
+            self.server = server
+            self._server_spec = (os.path.abspath(pkl_file), tuple(identifiers), column, derived and os.path.abspath(derived))
+            self.dictionary = None
+            self.identifiers = identifiers
+            self.column = column
+            self.derived = {}
+            self.id_keys = self._remote('id_keys')
+            return
+        if isinstance(pkl_file, results_store.results_store):
+            self.store = pkl_file
+        elif type(pkl_file) is str and os.path.isdir(pkl_file):
+            self.store = results_store.results_store.load(pkl_file)
+        elif type(pkl_file) is str:
             self.dictionary = utils.load_pkl(pkl_file)
         else:
             self.dictionary = pkl_file
         self.identifiers = identifiers
-        self.id_keys = utils.id_keys(self.dictionary, self.identifiers)
-        self.title = title
+        self.column = column
+        if self.store is None:
+            self.id_keys = utils.id_keys(self.dictionary, self.identifiers)
+        else:
+            self.dictionary = None
+            self.id_keys = self.store.id_keys()
+        if type(derived) is str:
+            derived = utils.load_pkl(derived)
+        self.derived = derived or {}
+
+    def _remote(self, name, *args, **kwargs):
+        return self.server.call(self._server_spec, name, *args, **kwargs)
 
     def create_lists(self, *keys, **kwargs):
+        if self.server is not None:
+            return self._remote('create_lists', *keys, **kwargs)
+        if self.store is not None:
+            return self.store.create_lists(keys, self.column, **kwargs)
         return utils.create_lists(self.dictionary, keys, **kwargs)
 
     def create_lists_beams(self, *keys):
+        if self.server is not None:
+            return self._remote('create_lists_beams', *keys)
+        if self.store is not None:
+            return self.store.create_lists_beams(keys, self.column)
         return utils.create_lists_beams(self.dictionary, keys)
 
+    def create_grid(self, *keys, **kwargs):
+        """
+        Like create_lists, but every 'VAR' in keys is a free axis, e.g.
+        create_grid('ArcDipReal', 'VAR', 'VAR', 'VAR') for a SEY x intensity x energy map.
+        Returns the list of axes and an array with one dimension per axis, NaN for missing runs.
+        """
+        if self.server is not None:
+            return self._remote('create_grid', *keys, **kwargs)
+        if self.store is not None:
+            return self.store.create_grid(keys, self.column, **kwargs)
+        if self._key_index is None:
+            self._key_index = utils.key_index(self.dictionary, len(self.identifiers))
+        columns, values = self._key_index
+        return utils.create_grid_from_index(columns, values, keys, **kwargs)
+
+    def create_lists_sum(self, placeholder, values, *keys):
+        """
+        Adds up the results for each of values in place of placeholder in keys,
+        e.g. create_lists_sum('DEV', ['MB', 'MQ'], 'DEV', '6500', 'VAR', '1.1').
+        """
+        if self.server is not None:
+            return self._remote('create_lists_sum', placeholder, values, *keys)
+        if self.store is not None:
+            return self.store.create_lists_sum(keys, placeholder, values, self.column)
+        return utils.create_lists_sum(self.dictionary, keys, placeholder, values)
+
+    def query(self, x, **selection):
+        """
+        Only for studies on a results_store.
+        Returns xx, yy for the identifier x and all runs matching selection, sorted by xx.
+        selection: identifier=value or identifier=list of values
+        """
+        if self.server is not None:
+            return self._remote('query', x, **selection)
+        if self.store is None:
+            raise ValueError('query needs a results_store')
+        return self.store.query(x, self.column, **selection)
+
     def get_first_entry(self):
+        if self.server is not None:
+            return self._remote('get_first_entry')
+        if self.store is not None:
+            return self.store.columns[self.column][0]
         keys = ['PASS'] * len(self.identifiers)
         return utils.create_lists(self.dictionary, keys, expert=True)[0][0]
 
+    def create_lists_paths(self, *keys, **kwargs):
+        """
+        create_lists for the mat file paths: the 'path' column of a results_store,
+        otherwise the dict of this study, which must be paths_matfiles_pyecloud.pkl.
+        """
+        if self.store is not None:
+            return self.store.create_lists(keys, 'path', **kwargs)
+        return self.create_lists(*keys, **kwargs)
+
     def create_lists_path(self, func_name, func_args, func_kwargs, *keys, **kwargs):
-        xx, paths = self.create_lists(*keys, **kwargs)
-        yy = []
-        for path in paths:
-            sim = simulation_from_path(path)
-            function = getattr(sim, func_name)
-            yy.append(function(*func_args, **func_kwargs))
-        return xx, np.array(yy)
+        """
+        Calls the simulation_from_path method func_name for every path of create_lists(*keys).
+        Derived quantities without arguments are served from self.derived, if stored.
+        So are time series called with only n_points, if their envelope was stored.
+        prefetch (keyword, default 0): number of simulations that are evaluated ahead in threads,
+        so that reading the next files overlaps with the current computation.
+        """
+        if self.server is not None:
+            return self._remote('create_lists_path', func_name, func_args, func_kwargs, *keys, **kwargs)
+        depth = kwargs.pop('prefetch', 0)
+        if func_name in self.derived and not func_args and not func_kwargs:
+            return self.create_lists_derived(func_name, *keys, **kwargs)
+        if func_name+'_envelope' in self.derived and not func_args and func_kwargs.keys() == ['n_points']:
+            xx, envelopes = utils.create_lists(self.derived[func_name+'_envelope'], keys, **kwargs)
+            n_points = func_kwargs['n_points']
+            # Otherwise the raw series are needed, as in simulation_general.time_series
+            if all(env.resolves(n_points) for env in envelopes):
+                return xx, _array_or_objects([env.level(n_points) for env in envelopes])
+        xx, paths = self.create_lists_paths(*keys, **kwargs)
+        def evaluate(path):
+            function = getattr(sim_cache.get(path), func_name)
+            return function(*func_args, **func_kwargs)
+        yy = list(prefetch.prefetch(evaluate, paths, depth))
+        return xx, _array_or_objects(yy)
+
+    def create_lists_derived(self, name, *keys, **kwargs):
+        """
+        Same output as create_lists_path(name, (), {}, *keys), from the stored derived quantities.
+        """
+        if self.server is not None:
+            return self._remote('create_lists_derived', name, *keys, **kwargs)
+        if name not in self.derived:
+            raise ValueError('Derived quantity %s was not stored' % name)
+        xx, yy = utils.create_lists(self.derived[name], keys, **kwargs)
+        return xx, _array_or_objects(yy)
+
+    def create_lists_batch(self, func_name, func_args, func_kwargs, *keys, **kwargs):
+        """
+        Like create_lists_path, but func_name is a method of simulation_batch that
+        evaluates all simulations at once. Time series are returned as 2-D arrays padded with NaN.
+        """
+        if self.server is not None:
+            return self._remote('create_lists_batch', func_name, func_args, func_kwargs, *keys, **kwargs)
+        xx, paths = self.create_lists_paths(*keys, **kwargs)
+        batch = simulation_batch.from_paths(paths)
+        function = getattr(batch, func_name)
+        return xx, function(*func_args, **func_kwargs)
 
 simulation_study = heatload_study
 
 
+class bunch_index(object):
+    """
+    Cumulative heat load of a simulation, with the number of time steps before and up to
+    every bunch passage. Built once per simulation, it gives heat loads of train splits
+    with table lookups.
+    The arrays are shared by all users of a cached simulation and are read-only.
+    """
+    def __init__(self, t_arr, hl_arr, b_spac):
+        self.hl_arr = hl_arr
+        self.b_spac_arr = t_arr / b_spac
+        # Sums of hl_arr before index i, and from index i on
+        self.cumsum = np.concatenate([[0.], np.cumsum(hl_arr)])
+        self.cumsum_rev = np.concatenate([np.cumsum(hl_arr[::-1])[::-1], [0.]])
+        # Number of time steps with b_spac_arr < k and <= k, for all integer k up to the last passage
+        passages = np.arange(int(np.ceil(self.b_spac_arr[-1])) + 1)
+        self.n_below = np.searchsorted(self.b_spac_arr, passages, 'left')
+        self.n_below_equal = np.searchsorted(self.b_spac_arr, passages, 'right')
+        for arr in (self.hl_arr, self.b_spac_arr, self.cumsum, self.cumsum_rev, self.n_below, self.n_below_equal):
+            arr.flags.writeable = False
+        self._passages = {}
+
+    def nbytes(self):
+        arrays = [self.hl_arr, self.b_spac_arr, self.cumsum, self.cumsum_rev, self.n_below, self.n_below_equal]
+        for passage in self._passages.values():
+            arrays.extend(passage)
+        return sum(arr.nbytes for arr in arrays)
+
+    def _n_steps(self, first_train, table, side):
+        first_train = np.asarray(first_train)
+        if first_train.dtype.kind in 'iu' and np.all(first_train >= 0) and np.all(first_train < len(table)):
+            return table[first_train]
+        return np.searchsorted(self.b_spac_arr, first_train, side)
+
+    def heatload_before(self, first_train):
+        """
+        Heat load of the time steps before bunch passage first_train.
+        """
+        return self.cumsum[self._n_steps(first_train, self.n_below, 'left')]
+
+    def heatload_after(self, first_train):
+        """
+        Heat load of the time steps after bunch passage first_train.
+        """
+        return self.cumsum_rev[self._n_steps(first_train, self.n_below_equal, 'right')]
+
+    def heatload_passage(self, b_spac_arr):
+        """
+        Heat load per bunch passage, as in simulation_general.heatload_passage.
+        Cached for each b_spac_arr[-1]. Returns copies, which the caller can modify.
+        """
+        key = b_spac_arr[-1]
+        if key not in self._passages:
+            # sum to get hl per bunch passage, one point per bunch
+            shrink_factor = int(len(b_spac_arr)/b_spac_arr[-1])
+            yy_max = int(len(self.hl_arr)/shrink_factor)*shrink_factor
+            yy2 = np.sum(self.hl_arr[:yy_max].reshape(int(yy_max/shrink_factor), shrink_factor), axis=1)
+            xx2 = b_spac_arr[::shrink_factor]
+            self._passages[key] = xx2[:len(yy2)], yy2
+        xx2, yy2 = self._passages[key]
+        return xx2.copy(), yy2.copy()
+
 class simulation_general(object):
-    def electrons_in_chamber(self):
+    # In streaming mode, the time series are read from the mat file in chunks of
+    # chunk_size elements instead of being loaded into self.mat. Sums agree with the
+    # in-memory results up to rounding in the last bits, see mat_stream.mat_stream.sum.
+    streaming = False
+    chunk_size = 2**20
+
+    def get_mat_stream(self):
+        if getattr(self, '_mat_stream', None) is None:
+            self._mat_stream = mat_stream.mat_stream(self.mat.filename, self.chunk_size)
+        return self._mat_stream
+
+    def time_series(self, name, b_spac=None, n_points=None):
         """
         xx: bunch passages
-        yy: number of electrons in chamber
+        yy: time series name
+        n_points: if given, return about n_points buckets of the envelope of the series
+        instead, with yy of shape (M, 3) for min, max and mean of each bucket.
+        Series shorter than the finest envelope level are returned in full, with the same shape.
         """
-        xx = self.mat['t'][0,:]/self.b_spac
-        yy = self.mat['Nel_timep'][0,:]
+        if b_spac is None:
+            b_spac = self.b_spac
+        if n_points is not None:
+            env = self.get_envelope(name, b_spac)
+            if env.resolves(n_points):
+                return env.level(n_points)
+            xx, yy = self.time_series(name, b_spac)
+            return xx, np.column_stack([yy, yy, yy])
+        if not self.streaming:
+            return self.mat['t'][0,:] / b_spac, self.mat[name][0,:]
+
+        stream = self.get_mat_stream()
+        xx = np.empty(stream.variable('t').size)
+        start = 0
+        for chunk in stream.chunks('t'):
+            xx[start:start+len(chunk)] = chunk / b_spac
+            start += len(chunk)
+        yy = stream.read(name)[0,:]
         return xx, yy
 
+    def get_envelope(self, name, b_spac=None):
+        """
+        The envelope.envelope of the time series name, built on the first call.
+        """
+        if getattr(self, '_envelopes', None) is None:
+            self._envelopes = {}
+        key = (name, b_spac)
+        if key not in self._envelopes:
+            self._envelopes[key] = envelope.envelope(*self.time_series(name, b_spac))
+        return self._envelopes[key]
+
+    def get_bunch_index(self):
+        """
+        The bunch_index of this simulation, built on the first call.
+        """
+        if getattr(self, '_bunch_index', None) is None:
+            t_arr = self.mat['t'][0,:]
+            hl_arr = self.mat['En_imp_eV_time'][0,:] * const_LHC_frev * scipy_constant('e')
+            self._bunch_index = bunch_index(t_arr, hl_arr, self.b_spac)
+        return self._bunch_index
+
+    def electrons_in_chamber(self, n_points=None):
+        """
+        xx: bunch passages
+        yy: number of electrons in chamber
+        n_points: see time_series
+        """
+        return self.time_series('Nel_timep', n_points=n_points)
+
     def electrons_total_from_hist(self):
         """
         xx: bunch passages
@@ -75,22 +366,44 @@ class simulation_general(object):
         xx: Bunch passages
         yy: Heat load scaled with the revolution frequency of the LHC and in SI units
         """
-        if b_spac is None:
-            b_spac = self.b_spac
+        if self.streaming:
+            return self._heatload_passage_streaming(b_spac)
 
-        xx = self.mat['t'][0,:] / b_spac
-        yy = self.mat['En_imp_eV_time'][0,:] * const_LHC_frev * e
+        index = self.get_bunch_index()
+        if b_spac is None:
+            xx = index.b_spac_arr
+        else:
+            xx = self.mat['t'][0,:] / b_spac
 
-        # sum to get hl per bunch passage, one point per bunch
-        shrink_factor = int(len(xx)/xx[-1])
-        yy_max = int(len(yy)/shrink_factor)*shrink_factor
-        yy2 = np.sum(yy[:yy_max].reshape(int(yy_max/shrink_factor), shrink_factor), axis=1)
-        xx2 = xx[::shrink_factor]
+        return index.heatload_passage(xx)
 
+    def _heatload_passage_streaming(self, b_spac=None):
+        """
+        Same result as heatload_passage. The chunks are aligned to the bunch passages,
+        so every passage is summed as in the reshape of the in-memory version.
+        """
+        if b_spac is None:
+            b_spac = self.b_spac
+        stream = self.get_mat_stream()
+        xx_last = np.ravel(stream.last('t') / b_spac)[0]
+        shrink_factor = int(stream.variable('t').size/xx_last)
+        n_passages = stream.variable('En_imp_eV_time').size // shrink_factor
+
+        yy2 = np.empty(n_passages)
+        start = 0
+        for chunk in stream.chunks('En_imp_eV_time', multiple=shrink_factor):
+            n_rows = min(len(chunk)//shrink_factor, n_passages-start)
+            chunk = chunk[:n_rows*shrink_factor] * const_LHC_frev * scipy_constant('e')
+            yy2[start:start+n_rows] = np.sum(chunk.reshape(n_rows, shrink_factor), axis=1)
+            start += n_rows
+
+        xx2 = np.concatenate([chunk[::shrink_factor] / b_spac for chunk in stream.chunks('t', multiple=shrink_factor)])
         return xx2[:len(yy2)], yy2
 
     def heatload_total(self):
-        return np.sum(self.mat['En_imp_eV_time']) * const_LHC_frev * e
+        if self.streaming:
+            return self.get_mat_stream().sum('En_imp_eV_time') * const_LHC_frev * scipy_constant('e')
+        return np.sum(self.mat['En_imp_eV_time']) * const_LHC_frev * scipy_constant('e')
 
     def angle_hist_total(self):
         """
@@ -100,15 +413,11 @@ class simulation_general(object):
         xx = np.linspace(0, 1, len(yy))
         return xx, yy
 
-    def kinetic_energy(self):
-        xx = self.mat['t'][0,:] / self.b_spac
-        yy = self.mat['En_kin_eV_time'][0,:]
-        return xx, yy
+    def kinetic_energy(self, n_points=None):
+        return self.time_series('En_kin_eV_time', n_points=n_points)
 
-    def central_density(self):
-        xx = self.mat['t'][0,:] / self.b_spac
-        yy = self.mat['cen_density'][0,:]
-        return xx, yy
+    def central_density(self, n_points=None):
+        return self.time_series('cen_density', n_points=n_points)
 
     def energy_impact_hist(self):
         xx = self.mat['xg_hist'][0,:]
@@ -118,9 +427,9 @@ class simulation_general(object):
 
 
 class simulation(simulation_general):
-    def __init__(self, mat_or_matfile):
+    def __init__(self, mat_or_matfile, cache=None):
         if type(mat_or_matfile) is str:
-            mat = sio.loadmat(mat_or_matfile)
+            mat = utils.lazy_mat(mat_or_matfile, cache)
         else:
             mat = mat_or_matfile
         self.mat = mat
@@ -128,16 +437,20 @@ class simulation(simulation_general):
 
 
 class simulation_from_path(simulation_general):
-    def __init__(self, path):
+    def __init__(self, path, cache=None, streaming=False, chunk_size=None):
         directory = os.path.abspath(os.path.dirname(os.path.expanduser(path)))
 
         pyecltest = directory+'/Pyecltest.mat'
-        beam_beam = utils.load_file_as_module(directory+'/beam.beam')
-        machine_parameters = utils.load_file_as_module(directory+'/machine_parameters.input')
-        simulation_parameters = utils.load_file_as_module(directory+'/simulation_parameters.input')
-        secondary_emission_parameters = utils.load_file_as_module(directory+'/secondary_emission_parameters.input')
-
-        self.mat = sio.loadmat(pyecltest)
+        with instrumentation.stage('input files'):
+            beam_beam = utils.load_input_file(directory+'/beam.beam')
+            machine_parameters = utils.load_input_file(directory+'/machine_parameters.input')
+            simulation_parameters = utils.load_input_file(directory+'/simulation_parameters.input')
+            secondary_emission_parameters = utils.load_input_file(directory+'/secondary_emission_parameters.input')
+
+        self.mat = utils.lazy_mat(pyecltest, cache)
+        self.streaming = streaming
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
         self. Dt = simulation_parameters.Dt,
         self.dec_fact_out = simulation_parameters.dec_fact_out,
         self.b_spac = beam_beam.b_spac,
@@ -153,27 +466,36 @@ class simulation_from_path(simulation_general):
         the rest of the beam is supposed to be the second train.
         The heat load of the first train and the second train is rescaled to the total bunches,
         where the first train is only considered once.
+        first_train and bunches_rescaled can also be arrays, to scan them in one call.
+        With arrays of first_train, the masks of details have one row per element.
         """
-        hl_arr = self.mat['En_imp_eV_time'][0,:] * const_LHC_frev * e
-        t_arr = self.mat['t'][0,:]
-        b_spac_arr = t_arr/self.b_spac
+        index = self.get_bunch_index()
 
-        mask_first_bunch = b_spac_arr < first_train
-        mask_second_bunch = b_spac_arr > first_train
-        n_bunches_first = np.sum(self.filling_pattern[:first_train])
-        n_bunches_second = np.sum(self.filling_pattern[first_train:])
+        # Same as np.sum(self.filling_pattern[:first_train]), also for arrays of first_train
+        n_filling = len(self.filling_pattern)
+        first_train_arr = np.asarray(first_train)
+        slice_end = np.where(first_train_arr < 0, np.maximum(n_filling+first_train_arr, 0), np.minimum(first_train_arr, n_filling))
+        cumsum_filling = np.concatenate([[0], np.cumsum(self.filling_pattern)])
+        n_bunches_first = cumsum_filling[slice_end]
+        n_bunches_second = cumsum_filling[-1] - n_bunches_first
 
         factor2 = (bunches_rescaled - n_bunches_first)/n_bunches_second
-        hl1 = np.sum(hl_arr[mask_first_bunch])
-        hl2 = np.sum(hl_arr[mask_second_bunch])
+        hl1 = index.heatload_before(first_train)
+        hl2 = index.heatload_after(first_train)
 
         hl = hl1 + hl2 * factor2
         if double_hl:
             hl *= 2
 
         if verbose or details:
+            hl_arr = index.hl_arr.copy()
+            t_arr = self.mat['t'][0,:]
+            b_spac_arr = index.b_spac_arr.copy()
+            split = first_train_arr[..., np.newaxis] if first_train_arr.ndim else first_train
+            mask_first_bunch = b_spac_arr < split
+            mask_second_bunch = b_spac_arr > split
             factor_alt = bunches_rescaled/(n_bunches_first+n_bunches_second)
-            hl_alt = np.sum(hl_arr) * factor_alt
+            hl_alt = index.cumsum[-1] * factor_alt
             if verbose:
                 for key, value in locals().iteritems():
                     if '__' not in key:
@@ -197,11 +519,10 @@ class simulation_from_path(simulation_general):
             double_hl: Apply a factor 2 to the output.
         """
         bunch_int = np.array([self.beam_beam.fact_beam * self.filling_pattern])
-        sigma_t = self.beam_beam.sigmaz/c
+        sigma_t = self.beam_beam.sigmaz/scipy_constant('c')
         fill_energy = self.beam_beam.energy_eV
         #n_bunches = np.sum(self.filling_pattern)
-        imp = imp_calc.calculate_P_Wm(bunch_int, sigma_t, fill_energy) * const_len_cryogenic_cell
-        sr = sr_calc.calculate_P_Wm(bunch_int, sigma_t, fill_energy) * const_len_cryogenic_cell
+        imp, sr = calc_cache.get(bunch_int, sigma_t, fill_energy)
 
         if bunches_rescaled is None:
             factor_bunches = 1
@@ -214,3 +535,289 @@ class simulation_from_path(simulation_general):
             factor_double = 1
         return imp*factor_bunches*factor_double, sr*factor_bunches*factor_double
 
+
+class heatload_calc_cache(object):
+    """
+    LRU cache of the impedance and synchrotron radiation heat loads per cryogenic cell,
+    keyed by a hash of the bunch intensities, sigma_t and the energy.
+    If filename is given, the cache is read from this pickle file and written back
+    whenever a new beam configuration was calculated.
+    """
+    def __init__(self, max_entries=1000, filename=None):
+        self.max_entries = max_entries
+        self.filename = filename
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if filename is not None and os.path.isfile(filename):
+            with open(filename) as f:
+                self._cache.update(cPickle.load(f))
+
+    @staticmethod
+    def key(bunch_int, sigma_t, energy):
+        bunch_int = np.ascontiguousarray(bunch_int, dtype=float)
+        hash_ = hashlib.sha1(bunch_int.tobytes())
+        hash_.update(repr((bunch_int.shape, float(sigma_t), float(energy))))
+        return hash_.hexdigest()
+
+    def get(self, bunch_int, sigma_t, energy):
+        """
+        Returns imp, sr as in simulation_from_path.calc_impedance_sr without rescaling.
+        """
+        key = self.key(bunch_int, sigma_t, energy)
+        if key in self._cache:
+            self.hits += 1
+            value = self._cache.pop(key)
+            self._cache[key] = value
+            return value
+
+        self.misses += 1
+        imp_calc, sr_calc = get_calculators()
+        imp = imp_calc.calculate_P_Wm(bunch_int, sigma_t, energy) * const_len_cryogenic_cell
+        sr = sr_calc.calculate_P_Wm(bunch_int, sigma_t, energy) * const_len_cryogenic_cell
+        self._cache[key] = imp, sr
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        if self.filename is not None:
+            self.save()
+        return imp, sr
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as f:
+            cPickle.dump(self._cache, f, -1)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Used by simulation_from_path.calc_impedance_sr.
+# Replace with heatload_calc_cache(filename=...) to keep the results between sessions.
+calc_cache = heatload_calc_cache()
+
+
+class simulation_cache(object):
+    """
+    LRU cache of simulation_from_path objects, keyed by the resolved directory
+    and the mtime of Pyecltest.mat.
+    The least recently used simulations are dropped when the memory of all cached
+    simulations exceeds max_bytes, see simulation_nbytes.
+    """
+    def __init__(self, max_bytes=2e9):
+        self.max_bytes = max_bytes
+        self._cache = collections.OrderedDict()
+        # get can be called from the threads of create_lists_path(prefetch=...)
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, path):
+        directory = os.path.realpath(os.path.dirname(os.path.expanduser(path)))
+        key = (directory, os.path.getmtime(directory+'/Pyecltest.mat'))
+        with self._lock:
+            sim = self._cache.pop(key, None)
+            if sim is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                # Entries of an older version of this simulation are outdated
+                for old_key in self._cache.keys():
+                    if old_key[0] == directory:
+                        del self._cache[old_key]
+        if sim is None:
+            # Outside of the lock, so that other threads are not blocked by the file reads
+            sim = simulation_from_path(path)
+        with self._lock:
+            self._cache[key] = sim
+            self.evict()
+        return sim
+
+    def nbytes(self):
+        with self._lock:
+            return sum(simulation_nbytes(sim) for sim in self._cache.values())
+
+    def evict(self):
+        """
+        The most recently used simulation is always kept.
+        The sizes are evaluated again on every call, as the simulations load their arrays lazily.
+        """
+        with self._lock:
+            nbytes = self.nbytes()
+            while len(self._cache) > 1 and nbytes > self.max_bytes:
+                _, sim = self._cache.popitem(last=False)
+                nbytes -= simulation_nbytes(sim)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._cache),
+                    'nbytes': self.nbytes(),
+                    }
+
+def simulation_nbytes(sim):
+    """
+    Memory used by the arrays that sim has loaded, and by its bunch_index and envelopes.
+    """
+    nbytes = sum(getattr(arr, 'nbytes', 0) for arr in dict.values(sim.mat))
+    if getattr(sim, '_bunch_index', None) is not None:
+        nbytes += sim._bunch_index.nbytes()
+    for env in (getattr(sim, '_envelopes', None) or {}).values():
+        nbytes += env.nbytes()
+    return nbytes
+
+# Used by heatload_study.create_lists_path
+sim_cache = simulation_cache()
+
+
+def stack_padded(arrays, fill_value=0.):
+    """
+    Stacks arrays that differ in length along the first axis.
+    Returns the stacked array, padded with fill_value, and the lengths of the arrays.
+    The other axes, like the bins of histograms, must have the same size in all arrays.
+    """
+    lengths = np.array([len(arr) for arr in arrays])
+    trailing = np.shape(arrays[0])[1:]
+    for ctr, arr in enumerate(arrays):
+        if np.shape(arr)[1:] != trailing:
+            raise ValueError('Array %i has shape %s, array 0 has %s. Only the first axis can differ.' % (ctr, np.shape(arr), np.shape(arrays[0])))
+    shape = (len(arrays), lengths.max()) + trailing
+    stacked = np.empty(shape)
+    stacked.fill(fill_value)
+    for ctr, arr in enumerate(arrays):
+        stacked[ctr,:len(arr)] = arr
+    return stacked, lengths
+
+def length_mask(lengths):
+    """
+    Boolean mask of the valid entries of a padded array with these lengths.
+    """
+    return np.arange(lengths.max()) < lengths[:,np.newaxis]
+
+class simulation_batch(object):
+    """
+    Evaluates reductions over several simulations at once.
+    The arrays of all simulations are stacked into padded arrays, so the reductions
+    are single NumPy operations over the batch axis.
+    """
+    def __init__(self, sims):
+        self.sims = sims
+        self.b_spac = np.array([np.ravel(sim.b_spac)[0] for sim in sims])
+
+    @classmethod
+    def from_paths(cls, paths):
+        return cls([sim_cache.get(path) for path in paths])
+
+    def load(self, *names):
+        for sim in self.sims:
+            if hasattr(sim.mat, 'load'):
+                sim.mat.load(*names)
+
+    def time_series(self, name):
+        """
+        Returns the time series name of all simulations, padded with zeros, and their lengths.
+        """
+        return stack_padded([sim.mat[name][0,:] for sim in self.sims])
+
+    def axis(self, name):
+        """
+        Returns the histogram axis name, which must be the same for all simulations.
+        """
+        axis = np.squeeze(self.sims[0].mat[name])
+        for sim in self.sims[1:]:
+            if not np.array_equal(np.squeeze(sim.mat[name]), axis):
+                raise ValueError('%s of %s differs from %s' % (name, sim.mat.filename, self.sims[0].mat.filename))
+        return axis
+
+    def histograms(self, name):
+        """
+        Returns the histograms name (time x bins) of all simulations, padded with zeros
+        along the time axis, and their lengths.
+        """
+        return stack_padded([sim.mat[name] for sim in self.sims])
+
+    def heatload_total(self):
+        self.load('En_imp_eV_time')
+        yy, _ = self.time_series('En_imp_eV_time')
+        return np.sum(yy, axis=1) * const_LHC_frev * scipy_constant('e')
+
+    def heatload_passage(self, b_spac=None):
+        """
+        Same as simulation_general.heatload_passage for every simulation.
+        xx, yy: (n_simulations, n_passages), padded with NaN
+        """
+        if b_spac is None:
+            b_spac = self.b_spac
+        self.load('t', 'En_imp_eV_time')
+        tt, lengths = self.time_series('t')
+        hl, _ = self.time_series('En_imp_eV_time')
+        xx = tt / np.reshape(b_spac, (-1, 1))
+        hl *= const_LHC_frev * scipy_constant('e')
+
+        rows = np.arange(len(self.sims))
+        shrink_factors = (lengths/xx[rows,lengths-1]).astype(int)
+        n_passages = lengths // shrink_factors
+
+        xx2 = np.empty((len(self.sims), n_passages.max()))
+        xx2.fill(np.nan)
+        yy2 = xx2.copy()
+        # One vectorized reshape and sum per distinct number of points per passage
+        for shrink_factor in np.unique(shrink_factors):
+            group = rows[shrink_factors == shrink_factor]
+            n_max = n_passages[group].max()
+            summed = np.sum(hl[group,:n_max*shrink_factor].reshape(len(group), n_max, shrink_factor), axis=2)
+            valid = length_mask(n_passages[group])
+            yy2[group,:n_max] = np.where(valid, summed, np.nan)
+            xx2[group,:n_max] = np.where(valid, xx[group,:n_max*shrink_factor:shrink_factor], np.nan)
+
+        return xx2, yy2
+
+    def electrons_in_chamber(self):
+        """
+        xx, yy: (n_simulations, n_points), padded with NaN
+        """
+        self.load('t', 'Nel_timep')
+        tt, lengths = self.time_series('t')
+        yy, _ = self.time_series('Nel_timep')
+        mask = length_mask(lengths)
+        xx = np.where(mask, tt / self.b_spac[:,np.newaxis], np.nan)
+        return xx, np.where(mask, yy, np.nan)
+
+    def electrons_total_from_hist(self):
+        """
+        yy: (n_simulations, n_passages), padded with NaN
+        """
+        self.load('nel_hist')
+        hist, lengths = self.histograms('nel_hist')
+        yy = np.where(length_mask(lengths), np.sum(hist, axis=2), np.nan)
+        xx = np.arange(yy.shape[1], dtype=float)
+        return xx, yy
+
+    def angle_hist_total(self):
+        self.load('cos_angle_hist')
+        hist, _ = self.histograms('cos_angle_hist')
+        yy = np.sum(hist, axis=1)
+        xx = np.linspace(0, 1, yy.shape[1])
+        return xx, yy
+
+    def energy_impact_hist(self):
+        self.load('xg_hist', 'energ_eV_impact_hist')
+        hist, _ = self.histograms('energ_eV_impact_hist')
+        xx = self.axis('xg_hist')
+        return xx, np.sum(hist, axis=1)
+
+    def en_hist(self):
+        self.load('En_g_hist', 'En_hist')
+        hist, _ = self.histograms('En_hist')
+        xx = self.axis('En_g_hist')
+        return xx, np.sum(hist, axis=1)
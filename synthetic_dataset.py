@@ -0,0 +1,161 @@
+"""
+Writes fake PyECLOUD sweep trees for benchmarks and tests of the analysis scripts.
+
+Every simulation folder has a name that matches the regex of its study in
+ingestion.studies, a Pyecltest.mat with the variables used by simulation_study,
+and the four input files read by simulation_study.simulation_from_path.
+
+Usage:
+    python synthetic_dataset.py DIR --study dipquad -n 100
+"""
+from __future__ import division
+import os
+import re
+import argparse
+import itertools
+
+import numpy as np
+import scipy.io as sio
+
+import ingestion
+
+prefix_format = 'LHC_%(device)s_%(energy)sGeV_sey%(sey)s_%(intensity)se11ppb'
+
+# Folder name format and the values of the identifiers after sey, for each study
+study_formats = {
+        'f': ('Fill%(filln)s_cut%(time_of_interest)sh_6500GeV_for_triplets_%(beam)s_LHC_%(device)s_6500GeV_sey%(sey)s_coast%(coast)s',
+            {'filln': ['5219'], 'time_of_interest': ['1.5'], 'beam': ['B1', 'B2'], 'coast': ['0.5', '1.0']}),
+        'emax': (prefix_format + '_Emax_%(emax)s', {'emax': ['300', '400']}),
+        's': (prefix_format + '_s_param%(s)s', {'s': ['1.35', '1.40']}),
+        'musig': (prefix_format + '_ctr_%(ctr)s', {'ctr': ['10', '20']}),
+        'mu': (prefix_format + '_ctr_%(fact_mu)s', {'fact_mu': ['0.5', '1.0']}),
+        'theta': (prefix_format + '_theta_%(theta)s', {'theta': ['0.5', '1.0']}),
+        'r0': (prefix_format + '_R0_%(r0)s', {'r0': ['0.5', '0.7']}),
+        'ctr': (prefix_format + '_ctr_%(ctr)s', {'ctr': ['1', '2']}),
+        'sext': (prefix_format + '_%(df)s', {'df': ['d', 'f']}),
+        'dipquad': (prefix_format, {}),
+        'substeps': (prefix_format + '_f_substeps_%(substeps)s', {'substeps': ['1', '4']}),
+        'cell': (prefix_format + '_%(photoemission)s', {'photoemission': ['0', '1']}),
+        'energy': (prefix_format + '_%(distribution)s', {'distribution': ['gauss', 'mono']}),
+        'quad': (prefix_format + '_%(b_field)sTpm', {'b_field': ['12.1', '200.0']}),
+        'multip': (prefix_format + '_%(b_field_id)s', {'b_field_id': ['1', '2']}),
+        'mono': (prefix_format + '_mono_%(photoelectron_energy)seV', {'photoelectron_energy': ['7.0', '10.0']}),
+        }
+
+base_values = {
+        'device': ['ArcDipReal', 'ArcQuadReal'],
+        'energy': ['6500'],
+        'intensity': ['1.1', '1.2'],
+        }
+
+b_spac = 25e-9
+
+def sey_values(n_sey):
+    digits = len(str(n_sey)) + 1
+    return ['%.*f' % (digits, 1 + ctr/10**digits) for ctr in xrange(n_sey)]
+
+def folder_names(study, n_runs):
+    """
+    Returns a list of (folder name, identifier values) for n_runs simulations of study.
+    The SEY is the slowest varying identifier, so that all other combinations exist for each SEY.
+    The other identifiers vary fastest in the order of the regex groups, e.g. the beam of
+    study f, so that also small sweeps contain both values of most identifiers.
+    """
+    folder_format, study_values = study_formats[study]
+    regex, identifiers = ingestion.studies[study]
+    values = dict(base_values, **study_values)
+    # Reversed, as itertools.product varies the last element fastest
+    other_ids = [id_ for id_ in reversed(identifiers) if id_ != 'sey']
+    n_combinations = int(np.prod([len(values[id_]) for id_ in other_ids]))
+    values['sey'] = sey_values(-(-n_runs // n_combinations))
+
+    output = []
+    for sey in values['sey']:
+        for combination in itertools.product(*[values[id_] for id_ in other_ids]):
+            id_dict = dict(zip(other_ids, combination), sey=sey)
+            name = folder_format % id_dict
+            keys = [id_dict[id_] for id_ in identifiers]
+            info = re.search(regex, name)
+            if info is None or list(info.groups()) != keys:
+                raise ValueError('Folder %s does not match the regex of study %s' % (name, study))
+            output.append((name, keys))
+            if len(output) == n_runs:
+                return output
+    return output
+
+def write_matfile(filename, n_passages, steps_per_passage, n_bins, rng):
+    n_steps = n_passages * steps_per_passage
+    t = np.arange(n_steps) * b_spac / steps_per_passage
+    buildup = 1 - np.exp(-np.arange(n_steps) / (0.2*n_steps))
+    noise = lambda *shape: 1 + 0.1*rng.standard_normal(shape)
+
+    xg_hist = np.linspace(-0.02, 0.02, n_bins)
+    profile = np.exp(-xg_hist**2/(2*0.005**2))
+    hist_buildup = buildup[::steps_per_passage][:,np.newaxis]
+
+    mat = {
+            't': t,
+            'En_imp_eV_time': 1e7 * buildup * noise(n_steps),
+            'Nel_timep': 1e9 * buildup * noise(n_steps),
+            'En_kin_eV_time': 1e10 * buildup * noise(n_steps),
+            'cen_density': 1e11 * buildup * noise(n_steps),
+            'lam_t_array': np.tile(np.exp(-np.linspace(-3, 3, steps_per_passage)**2), n_passages),
+            'xg_hist': xg_hist,
+            'nel_hist': 1e7 * hist_buildup * profile * noise(n_passages, n_bins),
+            'energ_eV_impact_hist': 1e5 * hist_buildup * profile * noise(n_passages, n_bins),
+            'En_g_hist': np.linspace(0, 500, 100),
+            'En_hist': 1e6 * hist_buildup * np.exp(-np.linspace(0, 5, 100)) * noise(n_passages, 100),
+            'cos_angle_hist': 1e6 * hist_buildup * np.linspace(0, 1, 50) * noise(n_passages, 50),
+            }
+    sio.savemat(filename, mat, oned_as='row')
+
+def write_input_files(directory, sey, n_passages):
+    n_trains = -(-n_passages // 80)
+    with open(os.path.join(directory, 'beam.beam'), 'w') as f:
+        f.write('energy_eV = 6500e9\n')
+        f.write('fact_beam = 1.1e11\n')
+        f.write('b_spac = %r\n' % b_spac)
+        f.write('sigmaz = 1.2e-9/4*299792458.\n')
+        f.write('filling_pattern_file = %i*(72*[1.]+8*[0.])\n' % n_trains)
+    with open(os.path.join(directory, 'machine_parameters.input'), 'w') as f:
+        f.write("chamb_type = 'polyg'\n")
+        f.write('track_method = "StrongBdip"\n')
+    with open(os.path.join(directory, 'simulation_parameters.input'), 'w') as f:
+        f.write('Dt = 2.5e-11\n')
+        f.write('dec_fact_out = %i\n' % round(b_spac/10/2.5e-11))
+    with open(os.path.join(directory, 'secondary_emission_parameters.input'), 'w') as f:
+        f.write('del_max = %s\n' % sey)
+        f.write('R0 = 0.7\n')
+        f.write('E_th = 35.\n')
+
+def write_sweep(root_dir, study, n_runs, n_passages=100, steps_per_passage=10, n_bins=100, seed=0):
+    """
+    Writes n_runs simulation folders of study into root_dir.
+    The time series have n_passages*steps_per_passage points, the histograms
+    n_passages rows of n_bins bins.
+    Returns the list of (folder name, identifier values).
+    """
+    rng = np.random.RandomState(seed)
+    names = folder_names(study, n_runs)
+    sey_index = ingestion.studies[study][1].index('sey')
+    for name, keys in names:
+        directory = os.path.join(root_dir, name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_matfile(os.path.join(directory, 'Pyecltest.mat'), n_passages, steps_per_passage, n_bins, rng)
+        write_input_files(directory, keys[sey_index], n_passages)
+    return names
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes a fake PyECLOUD sweep.')
+    parser.add_argument('dir', help='Output directory.', metavar='DIR')
+    parser.add_argument('--study', help='Study type, as the options of 001_create_pickle_pyecloud_results.py. Default: dipquad.', default='dipquad', choices=sorted(ingestion.studies))
+    parser.add_argument('-n', help='Number of simulations. Default: 10.', type=int, default=10)
+    parser.add_argument('--passages', help='Number of bunch passages. Default: 100.', type=int, default=100)
+    parser.add_argument('--steps-per-passage', help='Time steps per bunch passage. Default: 10.', type=int, default=10)
+    parser.add_argument('--bins', help='Number of histogram bins. Default: 100.', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    names = write_sweep(args.dir, args.study, args.n, args.passages, args.steps_per_passage, args.bins, args.seed)
+    print('Wrote %i simulations to %s' % (len(names), args.dir))
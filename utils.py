@@ -1,21 +1,138 @@
 from __future__ import division
+import os
 import imp
+import ast
+import operator
+import hashlib
 import numpy as np
 import cPickle as pickle
 
+import instrumentation
+import segment_store
+import compact_hist
+
 def id_keys(dd, identifiers, verbose=False):
     """
     dict, identifiers
+    Returns identifier -> sorted values of this identifier in all branches of dd.
     """
     if verbose: print(identifiers)
     id_keys = {}
-    for id_ in identifiers:
-        value = dd.keys()
-        id_keys[id_] = sorted(value)
+    level = [dd]
+    for ctr, id_ in enumerate(identifiers):
+        last = ctr == len(identifiers) - 1
+        values = set()
+        next_level = []
+        for this_dd in level:
+            for key, value in this_dd.iteritems():
+                # Skip entries that end early, like xg_hist
+                if not last and type(value) is not dict:
+                    continue
+                values.add(key)
+                next_level.append(value)
+        id_keys[id_] = sorted(values)
         if verbose: print(id_keys[id_])
-        dd = dd[value[0]]
+        level = next_level
     return id_keys
 
+def flatten_nested_dict(dict_, depth):
+    """
+    Returns a list of (keys, value) for all entries of a nested dict that are
+    depth levels deep. Entries that end before depth (like xg_hist) are skipped.
+    """
+    items = [((), dict_)]
+    for level in xrange(depth):
+        new_items = []
+        for keys, dd in items:
+            if type(dd) is not dict:
+                continue
+            for key, value in dd.iteritems():
+                new_items.append((keys + (key,), value))
+        items = new_items
+    return items
+
+def key_index(dict_, depth):
+    """
+    Returns the keys of all entries of a nested dict that are depth levels deep as one
+    string array per level, and the entries in the same order.
+    """
+    items = flatten_nested_dict(dict_, depth)
+    columns = [np.array([keys[level] for keys, _ in items], dtype=str) for level in xrange(depth)]
+    return columns, [compact_hist.dense(value) for _, value in items]
+
+def _sorted_axis(values, convert_array):
+    """
+    Returns the unique values of a key column, numerically sorted if possible,
+    and the position of each entry in them.
+    """
+    axis, inverse = np.unique(values, return_inverse=True)
+    if convert_array:
+        try:
+            float_axis = np.array(axis, dtype=float)
+        except ValueError:
+            return axis, inverse
+        order = np.argsort(float_axis, kind='mergesort')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return float_axis[order], rank[inverse]
+    return axis, inverse
+
+def create_grid_from_index(columns, values, var_arr, convert_array=True, expert=False):
+    """
+    columns, values: as returned by key_index
+    var_arr: one entry per level, as in create_lists, but any number of them can be 'VAR'.
+    Returns the list of axes (one per VAR, in order) and an array with one dimension per
+    VAR (plus the dimensions of the entries), which is NaN where a run is missing.
+    Entries that are not numeric (e.g. paths) give an object array with None for missing runs.
+    """
+    var_arr = map(str, var_arr)
+    if len(var_arr) != len(columns):
+        print(var_arr)
+        raise ValueError('var_arr needs one entry per identifier')
+    mask = np.ones(len(values), dtype=bool)
+    for column, var in zip(columns, var_arr):
+        if var not in ('VAR', 'PASS'):
+            mask &= column == var
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        print(var_arr)
+        raise ValueError('No entries for var_arr')
+
+    axes, positions = [], []
+    for column, var in zip(columns, var_arr):
+        if var == 'VAR':
+            axis, position = _sorted_axis(column[rows], convert_array)
+            axes.append(axis)
+            positions.append(position)
+    shape = tuple(len(axis) for axis in axes)
+
+    flat_position = np.ravel_multi_index(positions, shape) if axes else np.zeros(len(rows), dtype=int)
+    flat_position, first = np.unique(flat_position, return_index=True)
+    if len(first) != len(rows) and not expert:
+        print(var_arr)
+        raise ValueError('Illegal use of PASS')
+    rows = rows[first]
+
+    try:
+        entries = np.array([values[row] for row in rows], dtype=float)
+        fill = np.nan
+    except (ValueError, TypeError):
+        entries = np.empty(len(rows), dtype=object)
+        entries[:] = [values[row] for row in rows]
+        fill = None
+    grid = np.empty((int(np.prod(shape)),) + entries.shape[1:], dtype=entries.dtype)
+    grid.fill(fill)
+    grid[flat_position] = entries
+    return axes, grid.reshape(shape + entries.shape[1:])
+
+def create_grid(dict_, var_arr, convert_array=True, expert=False):
+    """
+    N-dimensional version of create_lists: every 'VAR' in var_arr is an axis of the result.
+    See create_grid_from_index.
+    """
+    columns, values = key_index(dict_, len(var_arr))
+    return create_grid_from_index(columns, values, var_arr, convert_array, expert)
+
 def create_lists(dict_, var_arr, convert_array=True, expert=False):
     var_arr = map(str, var_arr)
     for ctr, var in enumerate(var_arr):
@@ -41,7 +158,7 @@ def create_lists(dict_, var_arr, convert_array=True, expert=False):
                             fail = True
                             break
                 if not fail:
-                    yy.append(this_dd)
+                    yy.append(compact_hist.dense(this_dd))
                     xx.append(key)
 
             if not xx:
@@ -74,54 +191,48 @@ def create_lists(dict_, var_arr, convert_array=True, expert=False):
 
     return [dict_], [42]
 
-def add_up_beams(xx1, yy1, xx2, yy2):
-    xx, yy = [], []
-    ctr1, ctr2 = 0, 0
-    x1, x2 = xx1[ctr1], xx2[ctr2]
-    while True:
-        if x1 == x2:
-            xx.append(x1)
-            yy.append(yy1[ctr1]+yy2[ctr2])
-            ctr1 += 1
-            ctr2 += 1
-        elif x1 < x2:
-            xx.append(x1)
-            yy.append(2*yy1[ctr1])
-            ctr1 += 1
-        elif x1 > x2:
-            xx.append(x2)
-            yy.append(2*yy2[ctr2])
-            ctr2 += 1
-
-        if ctr1 == len(xx1):
-            x1 = np.inf
-        else:
-            x1 = xx1[ctr1]
-        if ctr2 == len(xx2):
-            x2 = np.inf
-        else:
-            x2 = xx2[ctr2]
+def add_up_series(series):
+    """
+    Sums several (xx, yy) series on the sorted union of their xx.
+    Where a value of xx is missing in some of the series, the sum is scaled by
+    n_series/n_present. For two beams, a value present in only one beam is doubled.
+    """
+    xx_list = [np.asarray(xx) for xx, _ in series]
+    yy_list = [np.asarray(yy) for _, yy in series]
+    xx = np.unique(np.concatenate(xx_list))
 
-        if x1 == np.inf and x2 == np.inf:
-            try: xx = np.array(xx, float)
-            except: pass
-            try: yy = np.array(yy, float)
-            except: pass
+    yy = np.zeros((len(xx),) + yy_list[0].shape[1:], dtype=np.result_type(*yy_list))
+    n_present = np.zeros(len(xx), dtype=int)
+    for xx_i, yy_i in zip(xx_list, yy_list):
+        index = np.searchsorted(xx, xx_i)
+        yy[index] += yy_i
+        n_present[index] += 1
 
-            return xx,yy
+    factor = (len(series) / n_present).reshape((-1,) + (1,) * (yy.ndim - 1))
+    yy = yy * factor
 
-def create_lists_beams(dict_, var_arr):
-    var_arr1 = var_arr[:]
-    var_arr1[var_arr.index('BEAMS')] = 'B1'
-    var_arr2 = var_arr[:]
-    var_arr2[var_arr.index('BEAMS')] = 'B2'
+    try: xx = np.array(xx, float)
+    except: pass
+    return xx, yy
 
-    xx1, yy1 = create_lists(dict_, var_arr1)
-    xx2, yy2 = create_lists(dict_, var_arr2)
+def add_up_beams(xx1, yy1, xx2, yy2):
+    return add_up_series([(xx1, yy1), (xx2, yy2)])
 
-    xx, yy = add_up_beams(xx1, yy1, xx2, yy2)
+def create_lists_sum(dict_, var_arr, placeholder, values):
+    """
+    Adds up the create_lists results for each of values in place of placeholder in var_arr.
+    See add_up_series for the treatment of missing entries.
+    """
+    var_arr = list(var_arr)
+    series = []
+    for value in values:
+        this_var_arr = var_arr[:]
+        this_var_arr[var_arr.index(placeholder)] = value
+        series.append(create_lists(dict_, this_var_arr))
+    return add_up_series(series)
 
-    return xx, yy
+def create_lists_beams(dict_, var_arr):
+    return create_lists_sum(dict_, var_arr, 'BEAMS', ['B1', 'B2'])
 
 
 device_title_dict = {
@@ -133,6 +244,11 @@ device_title_dict = {
         }
 
 def load_pkl(f):
+    """
+    Also merges the segments written by 001_create_pickle_pyecloud_results.py --append.
+    """
+    if os.path.isdir(segment_store.segment_dir(f)):
+        return segment_store.load(f)
     with open(f) as f:
         return pickle.load(f)
 
@@ -146,5 +262,173 @@ def load_file_as_module(filename):
 
     return module
 
+_binary_operators = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: getattr(operator, 'div', operator.truediv),
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+        }
+_unary_operators = {
+        ast.USub: operator.neg,
+        ast.UAdd: operator.pos,
+        }
+
+class input_parameters(object):
+    """
+    Variables of a parsed input file, as attributes like in the module from load_file_as_module.
+    """
+    def __init__(self, variables):
+        self.__dict__.update(variables)
+
+def _eval_node(node, variables, operators):
+    if isinstance(node, ast.BinOp) and type(node.op) in operators:
+        left = _eval_node(node.left, variables, operators)
+        right = _eval_node(node.right, variables, operators)
+        try:
+            return operators[type(node.op)](left, right)
+        except (TypeError, ArithmeticError) as e:
+            raise ValueError('Cannot evaluate line %i: %s' % (node.lineno, e))
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in _unary_operators:
+        return _unary_operators[type(node.op)](_eval_node(node.operand, variables, operators))
+    elif isinstance(node, ast.Name) and node.id in variables:
+        return variables[node.id]
+    elif isinstance(node, ast.List):
+        return [_eval_node(elt, variables, operators) for elt in node.elts]
+    elif isinstance(node, ast.Tuple):
+        return tuple(_eval_node(elt, variables, operators) for elt in node.elts)
+    # Raises ValueError for anything else than a literal
+    return ast.literal_eval(node)
+
+def parse_input_file(content):
+    """
+    Returns the variables assigned in the source of a PyECLOUD input file, without executing it.
+    Only literals, arithmetic, lists, tuples and names assigned before are evaluated.
+    Raises ValueError for any other statement, including imports other than from __future__,
+    whose names could be used later in the file.
+    """
+    operators = _binary_operators.copy()
+    variables = {}
+    for statement in ast.parse(content).body:
+        if isinstance(statement, ast.Assign):
+            value = _eval_node(statement.value, variables, operators)
+            for target in statement.targets:
+                if isinstance(target, ast.Name):
+                    variables[target.id] = value
+                elif isinstance(target, (ast.Tuple, ast.List)) and all(isinstance(elt, ast.Name) for elt in target.elts):
+                    values = list(value)
+                    if len(values) != len(target.elts):
+                        raise ValueError('Wrong number of values to unpack')
+                    for elt, elt_value in zip(target.elts, values):
+                        variables[elt.id] = elt_value
+                else:
+                    raise ValueError('Unsupported assignment in line %i' % statement.lineno)
+        elif isinstance(statement, ast.ImportFrom) and statement.module == '__future__':
+            if 'division' in [alias.name for alias in statement.names]:
+                operators[ast.Div] = operator.truediv
+        elif isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Str):
+            continue
+        else:
+            raise ValueError('Unsupported statement in line %i' % statement.lineno)
+    return variables
+
+# Content hash -> input_parameters or module
+input_file_cache = {}
+
+def load_input_file(filename):
+    """
+    Replacement for load_file_as_module for PyECLOUD input files.
+    The file is parsed with parse_input_file. Files that it cannot handle are loaded
+    with load_file_as_module, which executes them. Each such fallback is printed and
+    counted as 'input file fallbacks' in instrumentation. The results are memoized by the hash of the file content,
+    so identical files share the same (read-only) object.
+    """
+    with open(filename) as f:
+        content = f.read()
+    key = hashlib.sha1(content).hexdigest()
+    if key not in input_file_cache:
+        try:
+            parameters = input_parameters(parse_input_file(content))
+        except (ValueError, SyntaxError) as e:
+            print('Executing input file %s, which cannot be parsed: %s' % (filename, e))
+            instrumentation.count('input file fallbacks')
+            parameters = load_file_as_module(filename)
+        input_file_cache[key] = parameters
+    return input_file_cache[key]
+
+# Set to a sidecar_cache.sidecar_cache to cache the variables of all lazy_mat objects
+mat_cache = None
+# Variables that lazy_mat keeps in memory as compact_hist.compact_array, e.g. compact_hist.hist_variables
+compact_variables = ()
+
+class lazy_mat(dict):
+    """
+    Dictionary of the variables of a .mat file.
+    A variable is read from the file the first time it is accessed and kept afterwards.
+    If cache (default: mat_cache) is set, the variables are read through this sidecar_cache.
+    The variables in compact (default: compact_variables) are kept as compact_hist.compact_array,
+    axes as shared arrays, and returned as dense arrays.
+    """
+    def __init__(self, filename, cache=None, compact=None):
+        dict.__init__(self)
+        if not os.path.isfile(filename):
+            raise IOError('File %s does not exist' % filename)
+        self.filename = filename
+        self.cache = cache
+        self.compact = compact
+        self._variable_names = None
+
+    def __getitem__(self, key):
+        return compact_hist.dense(dict.__getitem__(self, key))
+
+    def __missing__(self, key):
+        self.load(key)
+        return dict.__getitem__(self, key)
+
+    def load(self, *keys):
+        """
+        Reads all of keys that are not loaded yet in one pass over the file.
+        """
+        missing = [key for key in keys if not dict.__contains__(self, key)]
+        if not missing:
+            return
+        cache = self.cache if self.cache is not None else mat_cache
+        with instrumentation.stage('mat load'):
+            if cache is not None:
+                mat = cache.load(self.filename, missing)
+            else:
+                import scipy.io as sio
+                mat = sio.loadmat(self.filename, variable_names=missing)
+        compact = self.compact if self.compact is not None else compact_variables
+        for key in missing:
+            if key not in mat:
+                raise KeyError(key)
+            instrumentation.record_file(self.filename, mat[key].nbytes)
+            if key in compact_hist.axis_variables and key in compact:
+                self[key] = compact_hist.shared(mat[key])
+            elif key in compact:
+                self[key] = compact_hist.compact(mat[key])
+            else:
+                self[key] = mat[key]
+
+    def variable_names(self):
+        if self._variable_names is None:
+            import scipy.io as sio
+            self._variable_names = [name for name, _, _ in sio.whosmat(self.filename)]
+        return self._variable_names
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.variable_names()
+
+    def __iter__(self):
+        return iter(self.variable_names())
 
+    def keys(self):
+        return list(self.variable_names())
 
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default